@@ -0,0 +1,128 @@
+import torch
+from torch.nn.modules.loss import _Loss
+
+
+def class_sums(values, labels, num_classes):
+    """
+    Sum of values over the voxels of each class of labels, both of shape (B,1,H,W,D): shape (B,num_classes).
+    Each H slice is summed by scatter_add, then the slices by torch.sum, which keeps the float32 rounding
+    error of large volumes down to that of a plain sum.
+    """
+    rows = labels.shape[0] * labels.shape[2]
+    sums = torch.zeros(rows, num_classes, dtype=values.dtype, device=values.device)
+    sums = sums.scatter_add(1, labels.reshape(rows, -1), values.reshape(rows, -1))
+    return sums.reshape(labels.shape[0], labels.shape[2], num_classes).sum(1)
+
+
+class ClassIntersection(torch.autograd.Function):
+    """
+    class_sums(input.gather(1, labels), labels) for class probabilities input, shape (B,C,H,W,D), and the labels
+    of a label map target, shape (B,1,H,W,D). Only target, which the caller holds anyway, is kept for the backward
+    pass, instead of the int64 index of gather and scatter_add, twice its size for a float32 label map.
+    """
+
+    @staticmethod
+    def forward(ctx, input, target):
+        ctx.save_for_backward(target)
+        ctx.input_shape = input.shape
+        labels = target.long()
+        return class_sums(input.gather(1, labels), labels, input.shape[1])
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        target, = ctx.saved_tensors
+        labels = target.long()
+        # every voxel gets the gradient of the intersection of its own class
+        grad = grad_output.gather(1, labels.flatten(start_dim=1)).reshape(labels.shape)
+        grad_input = torch.zeros(ctx.input_shape, dtype=grad.dtype, device=grad.device)
+        return grad_input.scatter_(1, labels, grad), None
+
+
+class SoftmaxClassSums(torch.autograd.Function):
+    """
+    The intersections, ClassIntersection, and the volumes, summed over the voxels, of the class probabilities
+    softmax(logits), shape (B,C,H,W,D), with the labels of a label map target, shape (B,1,H,W,D).
+    Only logits and target are kept for the backward pass, rather than the probabilities, which are float32
+    even for half precision logits under cuda autocast. The backward pass recomputes the softmax and applies its
+    Jacobian in place, one class at a time, so the gradient is the only volume of the size of the logits it allocates.
+    """
+
+    @staticmethod
+    def forward(ctx, logits, target):
+        ctx.save_for_backward(logits, target)
+        probabilities = torch.softmax(logits, 1, dtype=torch.promote_types(logits.dtype, torch.float32))
+        labels = target.long()
+        intersection = class_sums(probabilities.gather(1, labels), labels, logits.shape[1])
+        return intersection, probabilities.flatten(start_dim=2).sum(2)
+
+    @staticmethod
+    def backward(ctx, grad_intersection, grad_sum):
+        logits, target = ctx.saved_tensors
+        probabilities = torch.softmax(logits, 1, dtype=grad_sum.dtype)
+        labels = target.long()
+        shape = grad_sum.shape + (1,) * (logits.dim() - 2)
+        # the gradient with respect to the probabilities is grad_sum of each class, plus grad_intersection
+        # of its own class at every voxel; the softmax Jacobian maps g to p * (g - sum_c p_c g_c)
+        grad_label = grad_intersection.gather(1, labels.flatten(start_dim=1)).reshape(labels.shape)
+        label_term = probabilities.gather(1, labels) * grad_label
+        dot = torch.bmm(grad_sum.unsqueeze(1), probabilities.flatten(start_dim=2)).reshape(labels.shape) + label_term
+        grad_sum = grad_sum.reshape(shape)
+        for c in range(probabilities.shape[1]):
+            probabilities[:, c:c + 1].mul_(grad_sum[:, c:c + 1] - dot)
+        grad_logits = probabilities.scatter_add_(1, labels, label_term)
+        return grad_logits.to(logits.dtype), None
+
+
+class LabelDiceLoss(_Loss):
+    """
+    monai.losses.DiceLoss(include_background=True) for a target given as a label map, shape (B,1,H,W,D),
+    without materializing its one-hot encoding: the probabilities of the target classes are gathered
+    from the input, one per voxel, and the per class intersections and target volumes are summed with
+    scatter_add over the label map (see ClassIntersection). The values and gradients are those of DiceLoss
+    on the one-hot target (with to_onehot_y=True, softmax=softmax). With softmax set, the softmax is fused
+    into the sums (see SoftmaxClassSums), and the class probabilities are not kept for the backward pass.
+
+    input is either class probabilities, shape (B,C,H,W,D), logits if softmax is set, or a second label map,
+    shape (B,1,H,W,D), for which num_classes has to be given. The Dice overlap being symmetric, a label map
+    input stands for its one-hot encoding.
+
+    reduction 'none' returns the loss per sample and class, shape (B,C,1,1,1), as DiceLoss.
+    """
+
+    def __init__(self, num_classes=None, softmax=False, reduction="mean", smooth_nr=1e-5, smooth_dr=1e-5):
+        super().__init__(reduction=reduction)
+        self.num_classes = num_classes
+        self.softmax = softmax
+        self.smooth_nr = float(smooth_nr)
+        self.smooth_dr = float(smooth_dr)
+
+    def forward(self, input, target):
+        if target.shape[1] != 1:
+            raise ValueError(f"expecting a label map target, shape (B,1,...), got target of shape {target.shape}")
+        labels = target.long()
+        if input.shape[1] == 1:
+            if self.num_classes is None:
+                raise ValueError("num_classes is required for a label map input")
+            num_classes = self.num_classes
+            input_labels = input.long()
+            intersection = class_sums((input_labels == labels).float(), labels, num_classes)
+            input_sum = class_sums(torch.ones((), device=input.device).expand(labels.shape), input_labels, num_classes)
+        else:
+            num_classes = input.shape[1]
+            if self.softmax:
+                intersection, input_sum = SoftmaxClassSums.apply(input, target)
+            else:
+                intersection = ClassIntersection.apply(input, target)
+                input_sum = input.flatten(start_dim=2).sum(2)
+        target_sum = class_sums(torch.ones((), dtype=intersection.dtype, device=labels.device).expand(labels.shape),
+                                labels, num_classes)
+
+        f = 1.0 - (2.0 * intersection + self.smooth_nr) / (input_sum + target_sum + self.smooth_dr)
+
+        if self.reduction == "mean":
+            return torch.mean(f)
+        if self.reduction == "sum":
+            return torch.sum(f)
+        if self.reduction == "none":
+            return f.reshape(f.shape + (1,) * (target.dim() - 2))
+        raise ValueError(f'Unsupported reduction: {self.reduction}, available options are ["mean", "sum", "none"].')
@@ -0,0 +1,76 @@
+import torch
+from torch.nn.modules.loss import _Loss
+
+
+def box_sum(x, kernel_size):
+    """
+    Sum of x, shape (B,C,H,W,D), over a cubic window of odd kernel_size centered on every voxel,
+    with zero padding at the borders. The window sums are differences of cumulative sums along each
+    spatial axis in turn, so the cost per voxel does not depend on kernel_size.
+    The cumulative sums are accumulated in float64: in float32 their rounding error grows with the
+    length of the line, and swamps the window sums of a constant background, whose local variance is 0.
+    """
+    radius = kernel_size // 2
+    for dim in range(2, x.dim()):
+        length = x.shape[dim]
+        # a leading zero, then the padded cumulative sum: window [i - r, i + r] is cum[i + 2r + 1] - cum[i]
+        pad = [0, 0] * (x.dim() - 1 - dim) + [radius + 1, radius]
+        cum = torch.nn.functional.pad(x, pad).cumsum(dim, dtype=torch.float64)
+        x = (cum.narrow(dim, kernel_size, length) - cum.narrow(dim, 0, length)).to(x.dtype)
+    return x
+
+
+class LocalNormalizedCrossCorrelationLoss(_Loss):
+    """
+    Local squared zero-normalized cross-correlation with a rectangular window, as
+    monai.losses.LocalNormalizedCrossCorrelationLoss(kernel_type='rectangular') at the pinned monai version,
+    but the five local sums are computed together by box_sum, at a cost per voxel that is the same for any
+    kernel_size. As there, the local variances are clamped at 0 and smooth_dr is added to their product,
+    so a window of constant intensity contributes smooth_nr / smooth_dr rather than dividing by 0.
+    """
+
+    def __init__(self, spatial_dims=3, kernel_size=3, reduction="mean", smooth_nr=0.0, smooth_dr=1e-5):
+        super().__init__(reduction=reduction)
+        if kernel_size % 2 == 0:
+            raise ValueError(f"kernel_size must be odd, got {kernel_size}")
+        self.spatial_dims = spatial_dims
+        self.kernel_size = kernel_size
+        self.kernel_vol = float(kernel_size ** spatial_dims)
+        self.smooth_nr = float(smooth_nr)
+        self.smooth_dr = float(smooth_dr)
+
+    def forward(self, pred, target):
+        if pred.dim() - 2 != self.spatial_dims:
+            raise ValueError(f"expecting pred with {self.spatial_dims} spatial dimensions, got pred of shape {pred.shape}")
+        if target.shape != pred.shape:
+            raise ValueError(f"ground truth has differing shape ({target.shape}) from pred ({pred.shape})")
+        # The local statistics are computed from the images minus their means, which keeps the sums of squares
+        # of e.g. Hounsfield units from cancelling out the local variances. Away from the borders, the means drop
+        # out of the statistics; windows reaching into the zero padding hold count < kernel_vol voxels, and get
+        # the remaining mean terms back.
+        spatial = tuple(range(2, pred.dim()))
+        t_mean = target.detach().mean(spatial, keepdim=True)
+        p_mean = pred.detach().mean(spatial, keepdim=True)
+        target = target - t_mean
+        pred = pred - p_mean
+        num_channels = pred.shape[1]
+        sums = box_sum(torch.cat([target, pred, target * target, pred * pred, target * pred], dim=1),
+                       self.kernel_size)
+        t_sum, p_sum, t2_sum, p2_sum, tp_sum = sums.split(num_channels, dim=1)
+        count = box_sum(torch.ones((1, 1) + pred.shape[2:], dtype=pred.dtype, device=pred.device), self.kernel_size)
+        border = 1 - count / self.kernel_vol
+
+        cross = tp_sum - p_sum * t_sum / self.kernel_vol + border * (t_mean * p_sum + p_mean * t_sum + t_mean * p_mean * count)
+        t_var = t2_sum - t_sum * t_sum / self.kernel_vol + border * (2 * t_mean * t_sum + t_mean * t_mean * count)
+        p_var = p2_sum - p_sum * p_sum / self.kernel_vol + border * (2 * p_mean * p_sum + p_mean * p_mean * count)
+        t_var = torch.clamp(t_var, min=0)
+        p_var = torch.clamp(p_var, min=0)
+        ncc = (cross * cross + self.smooth_nr) / (t_var * p_var + self.smooth_dr)
+
+        if self.reduction == "sum":
+            return torch.sum(ncc).neg()
+        if self.reduction == "none":
+            return ncc.neg()
+        if self.reduction == "mean":
+            return torch.mean(ncc).neg()
+        raise ValueError(f'Unsupported reduction: {self.reduction}, available options are ["mean", "sum", "none"].')
@@ -2,6 +2,26 @@ import monai
 import torch
 import numpy as np
 import matplotlib.pyplot as plt
+import functools
+from lncc import LocalNormalizedCrossCorrelationLoss
+from regularization import BendingEnergyLoss
+from dice import LabelDiceLoss
+
+
+def full_precision(loss_func):
+    """
+    Run loss_func in float32 even inside a mixed precision autocast region: floating point tensor
+    arguments are cast to float32 and autocast is disabled while it runs. For precision sensitive
+    losses, such as the variance terms of LNCC and the second derivatives of the bending energy.
+    """
+    @functools.wraps(loss_func)
+    def wrapper(*args, **kwargs):
+        args = [a.float() if torch.is_tensor(a) and a.is_floating_point() else a for a in args]
+        kwargs = {k: v.float() if torch.is_tensor(v) and v.is_floating_point() else v for k, v in kwargs.items()}
+        device_type = next((a.device.type for a in args if torch.is_tensor(a)), 'cpu')
+        with torch.autocast(device_type, enabled=False):
+            return loss_func(*args, **kwargs)
+    return wrapper
 
 
 def warp_func():
@@ -15,11 +35,11 @@ def warp_nearest_func():
     return warp_nearest
 
 
-def lncc_loss_func():
-    lncc_loss = monai.losses.LocalNormalizedCrossCorrelationLoss(
+def lncc_loss_func(kernel_size=3):
+    # box-filter version of monai.losses.LocalNormalizedCrossCorrelationLoss(kernel_type='rectangular')
+    lncc_loss = LocalNormalizedCrossCorrelationLoss(
         spatial_dims=3,
-        kernel_size=3,
-        kernel_type='rectangular',
+        kernel_size=kernel_size,
         reduction="mean",
         smooth_nr=1e-5,
         smooth_dr=1e-5,
@@ -27,21 +47,9 @@ def lncc_loss_func():
     return lncc_loss
 
 
-def similarity_loss(displacement_field, image_pair):
-    warp = warp_func()
-    lncc_loss = lncc_loss_func()
-    """ Accepts a batch of displacement fields, shape (B,3,H,W,D),
-        and a batch of image pairs, shape (B,2,H,W,D). """
-    warped_img2 = warp(image_pair[:, [1], :, :, :], displacement_field)
-    return lncc_loss(
-        warped_img2,  # prediction
-        image_pair[:, [0], :, :, :]  # target
-    )
-
-
 def regularization_loss_func():
-    # normalize=True, reduction='mean'
-    return monai.losses.BendingEnergyLoss(normalize=True, reduction='mean')
+    # separable version of monai.losses.BendingEnergyLoss(normalize=True, reduction='mean')
+    return BendingEnergyLoss(normalize=True, reduction='mean')
 
 
 def dice_loss_func():
@@ -54,65 +62,291 @@ def dice_loss_func():
     return dice_loss
 
 
-def dice_loss_func2():
+def dice_loss_per_sample_func():
     dice_loss = monai.losses.DiceLoss(
         include_background=True,
-        to_onehot_y=True,
+        to_onehot_y=False,
+        softmax=False,
+        reduction="none"
+    )
+    return dice_loss
+
+
+def dice_loss_func2():
+    # monai.losses.DiceLoss(include_background=True, to_onehot_y=True, softmax=True), without the one-hot target
+    dice_loss = LabelDiceLoss(
         softmax=True,
         reduction="mean"
     )
     return dice_loss
 
 
-def anatomy_loss(displacement_field, image_pair, seg_net, gt_seg1=None, gt_seg2=None, num_segmentation_classes=None):
+def label_dice_loss_func(num_segmentation_classes=None):
+    # dice_loss_func for a target given as a label map, shape (B,1,H,W,D), instead of its one-hot encoding
+    dice_loss = LabelDiceLoss(
+        num_classes=num_segmentation_classes,
+        reduction="mean"
+    )
+    return dice_loss
+
+
+def label_dice_loss_per_sample_func(num_segmentation_classes=None):
+    dice_loss = LabelDiceLoss(
+        num_classes=num_segmentation_classes,
+        reduction="none"
+    )
+    return dice_loss
+
+
+def softmax_dice_loss_func():
+    # label_dice_loss_func for seg_net logits, with the softmax fused into the loss
+    dice_loss = LabelDiceLoss(
+        softmax=True,
+        reduction="mean"
+    )
+    return dice_loss
+
+
+def softmax_dice_loss_per_sample_func():
+    dice_loss = LabelDiceLoss(
+        softmax=True,
+        reduction="none"
+    )
+    return dice_loss
+
+
+def seg_losses(batch, device, reg_net, seg_net, num_segmentation_classes):
     """
-    Accepts a batch of displacement fields, shape (B,3,H,W,D),
-    and a batch of image pairs, shape (B,2,H,W,D).
-    seg_net is the model used to segment an image,
-      mapping (B,1,H,W,D) to (B,C,H,W,D) where C is the number of segmentation classes.
-    gt_seg1 and gt_seg2 are ground truth segmentations for the images in image_pair, if ground truth is available;
-      if unavailable then they can be None.
-      gt_seg1 and gt_seg2 are expected to be in the form of class labels, with shape (B,1,H,W,D).
+    Losses of the seg_net training phase, for a batch of pairs with at least one ground truth segmentation.
     """
-    if gt_seg1 is not None:
-        # ground truth seg of target image
-        seg1 = monai.networks.one_hot(
-            gt_seg1, num_segmentation_classes
-        )
-    else:
-        # seg_net on target image, "noisy ground truth"
-        seg1 = seg_net(image_pair[:, [0], :, :, :]).softmax(dim=1)
-
-    if gt_seg2 is not None:
-        # ground truth seg of moving image
-        seg2 = monai.networks.one_hot(
-            gt_seg2, num_segmentation_classes
-        )
-    else:
-        # seg_net on moving image, "noisy ground truth"
-        seg2 = seg_net(image_pair[:, [1], :, :, :]).softmax(dim=1)
-
-    # seg1 and seg2 are now in the form of class probabilities at each voxel
-    # The trilinear interpolation of the function `warp` is then safe to use;
-    # it will preserve the probabilistic interpretation of seg2.
-    dice_loss = dice_loss_func()
-    warp = warp_func()
-    return dice_loss(
-        warp(seg2, displacement_field),  # warp of moving image segmentation
-        seg1  # target image segmentation
-    )
+    dice_loss = label_dice_loss_func(num_segmentation_classes)
+    softmax_dice_loss = softmax_dice_loss_func()
+    warp_nearest = warp_nearest_func()
+    img12 = batch['img12'].to(device)
+
+    displacement_fields = reg_net(img12)
+    # logits; the softmax is fused into the Dice loss wherever the prediction is not warped
+    seg1_predicted = seg_net(img12[:, [0], :, :, :])
+    seg2_predicted = seg_net(img12[:, [1], :, :, :])
+
+    # Below we compute the following:
+    # loss_supervised: supervised segmentation loss; compares ground truth seg with predicted seg
+    # loss_anatomy: anatomy loss; compares warped seg of moving image to seg of target image
+    # loss_metric: a single supervised seg loss, as a metric to track the progress of training
+    # Ground truth segs stay label maps, shape (B,1,H,W,D). Nearest neighbour warping of a label map is
+    # the label map of the warped one-hot seg, and the Dice overlap is symmetric, so whichever of the
+    # two segs of the anatomy loss is a label map can be the target of the label map Dice loss.
 
+    if 'seg1' in batch.keys() and 'seg2' in batch.keys():
+        seg1 = batch['seg1'].to(device)
+        seg2 = batch['seg2'].to(device)
+        loss_metric = softmax_dice_loss(seg2_predicted, seg2)
+        loss_supervised = loss_metric + softmax_dice_loss(seg1_predicted, seg1)
+        # The above supervised loss looks a bit different from the one in the paper
+        # in that it includes predictions for both images in the current image pair;
+        # we might as well do this, since we have gone to the trouble of loading
+        # both segmentations into memory.
+        loss_anatomy = dice_loss(warp_nearest(seg2, displacement_fields), seg1)
 
-def reg_losses(batch, device, reg_net, seg_net, num_segmentation_classes):
+    elif 'seg1' in batch.keys():  # seg1 available, but no seg2
+        seg1 = batch['seg1'].to(device)
+        loss_metric = softmax_dice_loss(seg1_predicted, seg1)
+        loss_supervised = loss_metric
+        # seg2_predicted is used in anatomy loss
+        loss_anatomy = dice_loss(warp_nearest(seg2_predicted.softmax(dim=1), displacement_fields), seg1)
+
+    else:  # seg2 available, but no seg1
+        assert('seg2' in batch.keys())
+        seg2 = batch['seg2'].to(device)
+        loss_metric = softmax_dice_loss(seg2_predicted, seg2)
+        loss_supervised = loss_metric
+        # seg1_predicted is used in anatomy loss
+        loss_anatomy = softmax_dice_loss(seg1_predicted, warp_nearest(seg2, displacement_fields))
+
+    # (If you want to refactor this code for *joint* training of reg_net and seg_net,
+    #  then use the definition of anatomy loss given in RegistrationLossEngine below,
+    #  where differentiable warping is used and reg net can be trained with it.)
+
+    return loss_supervised, loss_anatomy, loss_metric
+
+
+def per_sample_dice_loss(dice_loss, prediction, target):
+    """ Reduce the (B,C,1,1,1) output of a dice loss with reduction="none" to one loss per sample, shape (B,). """
+    return dice_loss(prediction, target).flatten(start_dim=1).mean(dim=1)
+
+
+def masked_mean(values, mask):
+    """ Mean of values, shape (B,), over the samples where the boolean mask is set; 0 if none is set. """
+    mask = mask.to(values.dtype)
+    return (values * mask).sum() / mask.sum().clamp(min=1)
+
+
+def fill_segmentation(gt_seg, seg_mask, image, seg_net, num_segmentation_classes):
+    """
+    Accepts a batch of placeholder-padded ground truth label maps, shape (B,1,H,W,D),
+    the boolean availability mask of the batch, shape (B,), and the images, shape (B,1,H,W,D).
+    Returns one-hot ground truth where it is available and seg_net class probabilities
+    ("noisy ground truth") elsewhere, shape (B,C,H,W,D).
+    Under mixed precision autocast, the softmax of the seg_net logits is taken in the dtype of the one-hot
+    ground truth, float32, so that both can share the tensor.
+    """
+    seg = monai.networks.one_hot(gt_seg, num_segmentation_classes)
+    missing = ~seg_mask
+    if missing.any():
+        seg[missing] = seg_net(image[missing]).softmax(dim=1, dtype=seg.dtype)
+    return seg
+
+
+def masked_seg_losses(batch, device, reg_net, seg_net, num_segmentation_classes):
+    """
+    seg_losses for a batch collated by masked_label_collate, which may mix segmentation availabilities.
+    Each term is computed per sample, then averaged over the samples that have at least one
+    ground truth segmentation; with a batch of one pair it matches seg_losses.
+    """
+    dice_loss = label_dice_loss_per_sample_func(num_segmentation_classes)
+    softmax_dice_loss = softmax_dice_loss_per_sample_func()
+    warp_nearest = warp_nearest_func()
     img12 = batch['img12'].to(device)
-    displacement_field12 = reg_net(img12)
-    loss_sim = similarity_loss(displacement_field12, img12)
-    regularization_loss = regularization_loss_func()
-    loss_reg = regularization_loss(displacement_field12)
+    seg1_mask = batch['seg1_mask'].to(device)
+    seg2_mask = batch['seg2_mask'].to(device)
+    any_mask = seg1_mask | seg2_mask
+
+    displacement_fields = reg_net(img12)
+    # logits, as in seg_losses
+    seg1_predicted = seg_net(img12[:, [0], :, :, :])
+    seg2_predicted = seg_net(img12[:, [1], :, :, :])
+    seg1 = batch['seg1'].to(device)
+    seg2 = batch['seg2'].to(device)
+
+    dice1 = per_sample_dice_loss(softmax_dice_loss, seg1_predicted, seg1)
+    dice2 = per_sample_dice_loss(softmax_dice_loss, seg2_predicted, seg2)
+    loss_supervised = masked_mean(dice1 * seg1_mask + dice2 * seg2_mask, any_mask)
+    loss_metric = masked_mean(torch.where(seg2_mask, dice2, dice1), any_mask)
+
+    # predictions stand in for the missing ground truth in the anatomy loss; as in seg_losses, the label maps
+    # are the targets of the Dice loss, and the pairs pick the anatomy loss of their availabilities
+    warped_seg2 = warp_nearest(seg2, displacement_fields)
+    anatomy_both = per_sample_dice_loss(dice_loss, warped_seg2, seg1)
+    anatomy_seg1 = per_sample_dice_loss(
+        dice_loss, warp_nearest(seg2_predicted.softmax(dim=1), displacement_fields), seg1)
+    anatomy_seg2 = per_sample_dice_loss(softmax_dice_loss, seg1_predicted, warped_seg2)
+    loss_anatomy = masked_mean(
+        torch.where(seg1_mask, torch.where(seg2_mask, anatomy_both, anatomy_seg1), anatomy_seg2), any_mask)
+
+    return loss_supervised, loss_anatomy, loss_metric
 
-    gt_seg1 = batch['seg1'].to(device) if 'seg1' in batch.keys() else None
-    gt_seg2 = batch['seg2'].to(device) if 'seg2' in batch.keys() else None
-    loss_ana = anatomy_loss(displacement_field12, img12,
-                            seg_net, gt_seg1, gt_seg2, num_segmentation_classes)
 
-    return loss_sim, loss_reg, loss_ana, displacement_field12
+class RegistrationLossEngine:
+    """
+    Losses of the reg_net training phase, built once per training run; with masked set, for batches collated
+    by masked_label_collate, which may mix segmentation availabilities.
+
+    The loss modules are created once, and the normalized identity grid of the warp is cached per
+    shape, device and dtype. The moving image and the moving segmentation are warped together, in a single
+    grid_sample call on the concatenated channels, so that the similarity, regularization and anatomy terms
+    come out of one shared pass over the displacement field.
+
+    The anatomy loss compares the warped moving segmentation with the target segmentation, each the ground
+    truth where it is available and the seg_net class probabilities ("noisy ground truth") elsewhere.
+    If per_sample is set, the similarity and anatomy losses are returned per pair, shape (B,);
+    their means are the batch losses.
+    """
+
+    def __init__(self, num_segmentation_classes, masked=False):
+        self.num_segmentation_classes = num_segmentation_classes
+        self.masked = masked
+        self.lncc_loss = lncc_loss_func()
+        self.lncc_loss_per_sample = lncc_loss_func()
+        self.lncc_loss_per_sample.reduction = "none"
+        self.regularization_loss = regularization_loss_func()
+        self.dice_loss = dice_loss_func()
+        self.dice_loss_per_sample = dice_loss_per_sample_func()
+        self.label_dice_loss = label_dice_loss_func()
+        self.label_dice_loss_per_sample = label_dice_loss_per_sample_func()
+        self.identity_grids = {}
+
+    def identity_grid(self, shape, device, dtype):
+        """
+        The identity sampling grid for volumes of the given spatial shape in grid_sample coordinates,
+        shape (1,H,W,D,3), and the scale from voxel displacements to those coordinates, per grid axis.
+        """
+        key = (tuple(shape), device, dtype)
+        if key not in self.identity_grids:
+            scale = torch.tensor([2 / max(dim - 1, 1) for dim in shape], device=device, dtype=dtype)
+            mesh = torch.meshgrid(*[torch.arange(dim, device=device, dtype=dtype) for dim in shape], indexing='ij')
+            grid = torch.stack(mesh, dim=-1) * scale - 1
+            # grid_sample expects the coordinates in x, y, z order, the reverse of the volume axes
+            self.identity_grids[key] = (grid.flip(-1).unsqueeze(0), scale.flip(0))
+        return self.identity_grids[key]
+
+    def warp(self, volume, displacement_field):
+        """ Warp volume, shape (B,C,H,W,D), like monai's Warp(mode="bilinear", padding_mode="border"). """
+        grid, scale = self.identity_grid(volume.shape[2:], volume.device, displacement_field.dtype)
+        grid = grid + displacement_field.permute(0, 2, 3, 4, 1).flip(-1) * scale
+        return torch.nn.functional.grid_sample(volume, grid, mode="bilinear", padding_mode="border", align_corners=True)
+
+    @full_precision
+    def terms(self, displacement_field, image_pair, seg1, seg2, per_sample=False):
+        """
+        The similarity, regularization and anatomy losses for a batch of displacement fields, image pairs,
+        and target and moving segmentations as class probabilities, shape (B,C,H,W,D); the target
+        segmentation may also be a ground truth label map, shape (B,1,H,W,D).
+        """
+        warped = self.warp(torch.cat([image_pair[:, [1], :, :, :], seg2], dim=1), displacement_field)
+        warped_img2, warped_seg2 = warped[:, :1], warped[:, 1:]
+        labels = seg1.shape[1] == 1
+        if per_sample:
+            loss_sim = self.lncc_loss_per_sample(warped_img2, image_pair[:, [0], :, :, :]).flatten(start_dim=1).mean(dim=1)
+            dice_loss = self.label_dice_loss_per_sample if labels else self.dice_loss_per_sample
+            loss_ana = per_sample_dice_loss(dice_loss, warped_seg2, seg1)
+        else:
+            loss_sim = self.lncc_loss(warped_img2, image_pair[:, [0], :, :, :])
+            loss_ana = (self.label_dice_loss if labels else self.dice_loss)(warped_seg2, seg1)
+        loss_reg = self.regularization_loss(displacement_field)
+        return loss_sim, loss_reg, loss_ana
+
+    def segmentations(self, batch, device, img12, seg_net):
+        """
+        The target and moving segmentations of a batch as class probabilities; a ground truth target
+        segmentation stays a label map, which the Dice loss takes as it is, unless the engine is masked.
+        """
+        if self.masked:
+            return tuple(
+                fill_segmentation(batch[key].to(device), batch[key + '_mask'].to(device), img12[:, [i], :, :, :],
+                                  seg_net, self.num_segmentation_classes)
+                for i, key in enumerate(('seg1', 'seg2')))
+        segs = []
+        for i, key in enumerate(('seg1', 'seg2')):
+            if key == 'seg1' and key in batch.keys():
+                segs.append(batch[key].to(device))
+            elif key in batch.keys():
+                segs.append(monai.networks.one_hot(batch[key].to(device), self.num_segmentation_classes))
+            else:
+                segs.append(seg_net(img12[:, [i], :, :, :]).softmax(dim=1))
+        return tuple(segs)
+
+    def __call__(self, batch, device, reg_net, seg_net, num_segmentation_classes=None, per_sample=False):
+        img12 = batch['img12'].to(device)
+        displacement_field12 = reg_net(img12)
+        seg1, seg2 = self.segmentations(batch, device, img12, seg_net)
+        loss_sim, loss_reg, loss_ana = self.terms(displacement_field12, img12, seg1, seg2, per_sample)
+        return loss_sim, loss_reg, loss_ana, displacement_field12
+
+    def compile(self, compile_func):
+        self.terms = compile_func(self.terms)
+
+
+def reg_losses(batch, device, reg_net, seg_net, num_segmentation_classes, per_sample=False):
+    """
+    Losses of the reg_net training phase, by a RegistrationLossEngine built for this call only;
+    training keeps one engine for the whole run instead.
+    """
+    return RegistrationLossEngine(num_segmentation_classes)(batch, device, reg_net, seg_net, per_sample=per_sample)
+
+
+def masked_reg_losses(batch, device, reg_net, seg_net, num_segmentation_classes, per_sample=False):
+    """
+    reg_losses for a batch collated by masked_label_collate, which may mix segmentation availabilities.
+    """
+    return RegistrationLossEngine(num_segmentation_classes, masked=True)(
+        batch, device, reg_net, seg_net, per_sample=per_sample)
@@ -0,0 +1,126 @@
+import torch
+from torch.nn.modules.loss import _Loss
+
+
+def central_difference(x, dim):
+    """ x[i + 1] - x[i - 1] along dim, one voxel shorter at both ends of dim. """
+    length = x.shape[dim] - 2
+    return x.narrow(dim, 2, length) - x.narrow(dim, 0, length)
+
+
+def second_differences(x, compact=False):
+    """
+    The second order finite differences of x, shape (B,C,H,W,D), one per pair of spatial dims dim_1 <= dim_2,
+    as (dim_1, dim_2, divisor, difference): the second derivative is difference / divisor, and every difference
+    is cropped to the same interior region, so they can be summed.
+
+    Each difference is built from the central difference along dim_1, which is shared by all the pairs of dim_1,
+    by one more 1D stencil along dim_2. By default, the pure second derivatives apply the central difference
+    twice, as monai's BendingEnergyLoss at the pinned version, and the interior drops 2 voxels per side.
+    If compact is set, they use the [1, -2, 1] stencil, as newer monai versions, and the interior drops 1.
+    """
+    margin = 1 if compact else 2
+    spatial_dims = range(2, x.dim())
+    for dim_1 in spatial_dims:
+        first = central_difference(x, dim_1)
+        for dim_2 in range(dim_1, x.dim()):
+            if compact and dim_1 == dim_2:
+                length = x.shape[dim_1] - 2
+                difference = x.narrow(dim_1, 2, length) - 2 * x.narrow(dim_1, 1, length) + x.narrow(dim_1, 0, length)
+                divisor = 1.
+            else:
+                difference = central_difference(first, dim_2)
+                divisor = 4.
+            for dim in spatial_dims:
+                length = x.shape[dim] - 2 * margin
+                difference = difference.narrow(dim, (difference.shape[dim] - length) // 2, length)
+            yield dim_1, dim_2, divisor, difference
+
+
+def term_weights(shape, dim_1, dim_2, divisor, normalize, dtype, device):
+    """
+    The weight of the squared difference of dim_1, dim_2 in the bending energy, per channel, shape (1,C,1,...):
+    the squared divisor, the 2 of the symmetric mixed derivatives, and with normalize the spatial size scaling
+    of monai's BendingEnergyLoss, shape[dim_1] * shape[dim_2] / shape[channel dim].
+    """
+    scale = torch.ones(shape[1], dtype=torch.float64)
+    if normalize:
+        scale = shape[dim_1] * shape[dim_2] / torch.tensor(shape[2:], dtype=torch.float64)
+    weights = (1. if dim_1 == dim_2 else 2.) * (scale / divisor) ** 2
+    return weights.to(dtype=dtype, device=device).reshape((1, -1) + (1,) * (len(shape) - 2))
+
+
+def bending_energy_sum(x, normalize, compact):
+    """ The bending energy of x summed over all voxels, channels and pairs. """
+    energy = 0.
+    for dim_1, dim_2, divisor, difference in second_differences(x, compact):
+        weights = term_weights(x.shape, dim_1, dim_2, divisor, normalize, x.dtype, x.device)
+        energy = energy + (difference.square() * weights).sum()
+    return energy
+
+
+class BendingEnergySum(torch.autograd.Function):
+    """
+    bending_energy_sum that keeps nothing but its input for the backward pass: the forward pass accumulates
+    one second difference at a time, and the backward pass recomputes them one at a time, backpropagating
+    each through its own small graph, so the memory is bounded by a few copies of the displacement field.
+    """
+
+    @staticmethod
+    def forward(ctx, x, normalize, compact):
+        ctx.save_for_backward(x)
+        ctx.normalize = normalize
+        ctx.compact = compact
+        with torch.no_grad():
+            return torch.as_tensor(bending_energy_sum(x, normalize, compact), dtype=x.dtype, device=x.device)
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        x, = ctx.saved_tensors
+        grad = torch.zeros_like(x)
+        with torch.enable_grad():
+            x = x.detach().requires_grad_()
+            for dim_1, dim_2, divisor, difference in second_differences(x, ctx.compact):
+                weights = term_weights(x.shape, dim_1, dim_2, divisor, ctx.normalize, x.dtype, x.device)
+                grad += torch.autograd.grad((difference.square() * weights).sum(), x)[0]
+        return grad * grad_output, None, None
+
+
+class BendingEnergyLoss(_Loss):
+    """
+    The bending energy of a displacement field, as monai.losses.BendingEnergyLoss with the same normalize
+    and reduction arguments, with the second derivatives from separable 1D stencils (see second_differences).
+    The 'mean' and 'sum' reductions go through BendingEnergySum, and do not keep any second derivative
+    for the backward pass.
+    """
+
+    def __init__(self, normalize=False, reduction="mean", compact=False):
+        super().__init__(reduction=reduction)
+        self.normalize = normalize
+        self.compact = compact
+
+    def forward(self, pred):
+        if pred.dim() not in (3, 4, 5):
+            raise ValueError(f"expecting 3-d, 4-d or 5-d pred, instead got pred of shape {pred.shape}")
+        margin = 1 if self.compact else 2
+        if any(size <= 2 * margin for size in pred.shape[2:]):
+            raise ValueError(f"all spatial dimensions must be > {2 * margin}, got spatial dimensions {pred.shape[2:]}")
+        if pred.shape[1] != pred.dim() - 2:
+            raise ValueError(f"number of channels of the displacement field, {pred.shape[1]}, "
+                             f"does not match number of spatial dimensions, {pred.dim() - 2}")
+
+        if self.reduction == "none":
+            energy = 0.
+            for dim_1, dim_2, divisor, difference in second_differences(pred, self.compact):
+                weights = term_weights(pred.shape, dim_1, dim_2, divisor, self.normalize, pred.dtype, pred.device)
+                energy = energy + difference.square() * weights
+            return energy
+        energy = BendingEnergySum.apply(pred, self.normalize, self.compact)
+        if self.reduction == "sum":
+            return energy
+        if self.reduction == "mean":
+            num_voxels = 1
+            for size in pred.shape[2:]:
+                num_voxels *= size - 2 * margin
+            return energy / (pred.shape[0] * pred.shape[1] * num_voxels)
+        raise ValueError(f'Unsupported reduction: {self.reduction}, available options are ["mean", "sum", "none"].')
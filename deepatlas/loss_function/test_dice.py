@@ -0,0 +1,186 @@
+import os
+import sys
+
+import monai
+import pytest
+import torch
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from dice import LabelDiceLoss, ClassIntersection, SoftmaxClassSums
+from losses import seg_losses, masked_seg_losses
+
+NUM_CLASSES = 4
+
+
+def label_map(shape, seed, dtype=torch.float64):
+    generator = torch.Generator().manual_seed(seed)
+    return torch.randint(NUM_CLASSES, shape, generator=generator).to(dtype)
+
+
+def probabilities(shape, seed, dtype=torch.float64):
+    generator = torch.Generator().manual_seed(seed)
+    return torch.randn(shape, generator=generator, dtype=dtype).softmax(dim=1)
+
+
+@pytest.mark.parametrize("reduction", ["mean", "sum", "none"])
+def test_label_target_matches_monai(reduction):
+    target = label_map((2, 1, 6, 5, 4), seed=1)
+    input = probabilities((2, NUM_CLASSES, 6, 5, 4), seed=2)
+    input_ref, input_label = input.clone().requires_grad_(), input.clone().requires_grad_()
+    expected = monai.losses.DiceLoss(to_onehot_y=True, reduction=reduction)(input_ref, target)
+    result = LabelDiceLoss(reduction=reduction)(input_label, target)
+    assert result.shape == expected.shape
+    torch.testing.assert_close(result, expected, rtol=1e-10, atol=1e-12)
+    weights = torch.rand(expected.shape, dtype=torch.float64)
+    (expected * weights).sum().backward()
+    (result * weights).sum().backward()
+    torch.testing.assert_close(input_label.grad, input_ref.grad, rtol=1e-10, atol=1e-12)
+
+
+def test_label_target_missing_classes():
+    # a class absent from the target and nearly absent from the input, as in small crops
+    target = label_map((2, 1, 6, 5, 4), seed=1).clamp(max=NUM_CLASSES - 2)
+    input = probabilities((2, NUM_CLASSES, 6, 5, 4), seed=2)
+    expected = monai.losses.DiceLoss(to_onehot_y=True, reduction="none")(input, target)
+    torch.testing.assert_close(LabelDiceLoss(reduction="none")(input, target), expected, rtol=1e-10, atol=1e-12)
+
+
+@pytest.mark.parametrize("reduction", ["mean", "none"])
+def test_label_map_input_matches_monai(reduction):
+    input = label_map((2, 1, 6, 5, 4), seed=3)
+    target = label_map((2, 1, 6, 5, 4), seed=4)
+    expected = monai.losses.DiceLoss(reduction=reduction)(
+        monai.networks.one_hot(input, NUM_CLASSES), monai.networks.one_hot(target, NUM_CLASSES))
+    result = LabelDiceLoss(num_classes=NUM_CLASSES, reduction=reduction)(input, target)
+    torch.testing.assert_close(result, expected, rtol=1e-10, atol=1e-12)
+
+
+def test_label_map_input_needs_num_classes():
+    with pytest.raises(ValueError):
+        LabelDiceLoss()(label_map((1, 1, 4, 4, 4), seed=0), label_map((1, 1, 4, 4, 4), seed=1))
+
+
+def test_class_intersection_gradcheck():
+    target = label_map((2, 1, 4, 3, 3), seed=5)
+    input = probabilities((2, NUM_CLASSES, 4, 3, 3), seed=6).requires_grad_()
+    assert torch.autograd.gradcheck(lambda x: ClassIntersection.apply(x, target), (input,))
+    assert torch.autograd.gradcheck(lambda x: LabelDiceLoss()(x, target), (input,))
+
+
+def logits(shape, seed, dtype=torch.float64):
+    generator = torch.Generator().manual_seed(seed)
+    return 3 * torch.randn(shape, generator=generator, dtype=dtype)
+
+
+@pytest.mark.parametrize("reduction", ["mean", "sum", "none"])
+@pytest.mark.parametrize("dtype", [torch.float64, torch.float32])
+def test_softmax_matches_monai(reduction, dtype):
+    target = label_map((2, 1, 6, 5, 4), seed=7, dtype=dtype)
+    input = logits((2, NUM_CLASSES, 6, 5, 4), seed=8, dtype=dtype)
+    input_ref, input_fused = input.clone().requires_grad_(), input.clone().requires_grad_()
+    expected = monai.losses.DiceLoss(to_onehot_y=True, softmax=True, reduction=reduction)(input_ref, target)
+    result = LabelDiceLoss(softmax=True, reduction=reduction)(input_fused, target)
+    tolerance = dict(rtol=1e-10, atol=1e-12) if dtype == torch.float64 else dict(rtol=1e-5, atol=1e-6)
+    assert result.shape == expected.shape
+    torch.testing.assert_close(result, expected, **tolerance)
+    weights = torch.rand(expected.shape, dtype=dtype)
+    (expected * weights).sum().backward()
+    (result * weights).sum().backward()
+    assert input_fused.grad.dtype == dtype
+    torch.testing.assert_close(input_fused.grad, input_ref.grad, **tolerance)
+
+
+def test_softmax_gradcheck():
+    target = label_map((2, 1, 4, 3, 3), seed=9)
+    input = logits((2, NUM_CLASSES, 4, 3, 3), seed=10).requires_grad_()
+    # both outputs, the intersections and the volumes, reach the in-place softmax Jacobian of the backward pass
+    assert torch.autograd.gradcheck(lambda x: SoftmaxClassSums.apply(x, target), (input,))
+    assert torch.autograd.gradcheck(lambda x: LabelDiceLoss(softmax=True)(x, target), (input,))
+
+
+class Displacement(torch.nn.Module):
+    """ A fixed displacement field of a few voxels, standing in for reg_net. """
+
+    def __init__(self, size, seed):
+        super().__init__()
+        generator = torch.Generator().manual_seed(seed)
+        self.field = 2 * torch.randn((1, 3) + (size,) * 3, generator=generator)
+
+    def forward(self, img12):
+        return self.field.expand(img12.shape[0], -1, -1, -1, -1).to(img12.dtype)
+
+
+def reference_seg_losses(batch, reg_net, seg_net):
+    """ The seg phase losses as train_network computed them, on one-hot ground truth with monai's DiceLoss. """
+    dice_loss = monai.losses.DiceLoss()
+    warp_nearest = monai.networks.blocks.Warp(mode="nearest", padding_mode="border")
+    img12 = batch['img12']
+    displacement_fields = reg_net(img12)
+    seg1_predicted = seg_net(img12[:, [0], :, :, :]).softmax(dim=1)
+    seg2_predicted = seg_net(img12[:, [1], :, :, :]).softmax(dim=1)
+    if 'seg1' in batch and 'seg2' in batch:
+        seg1 = monai.networks.one_hot(batch['seg1'], NUM_CLASSES)
+        seg2 = monai.networks.one_hot(batch['seg2'], NUM_CLASSES)
+        loss_metric = dice_loss(seg2_predicted, seg2)
+        loss_supervised = loss_metric + dice_loss(seg1_predicted, seg1)
+    elif 'seg1' in batch:
+        seg1 = monai.networks.one_hot(batch['seg1'], NUM_CLASSES)
+        loss_metric = dice_loss(seg1_predicted, seg1)
+        loss_supervised = loss_metric
+        seg2 = seg2_predicted
+    else:
+        seg2 = monai.networks.one_hot(batch['seg2'], NUM_CLASSES)
+        loss_metric = dice_loss(seg2_predicted, seg2)
+        loss_supervised = loss_metric
+        seg1 = seg1_predicted
+    loss_anatomy = dice_loss(warp_nearest(seg2, displacement_fields), seg1)
+    return loss_supervised, loss_anatomy, loss_metric
+
+
+def availability_batch(keys, size=8, seed=0):
+    generator = torch.Generator().manual_seed(seed)
+    batch = {'img12': torch.rand((2, 2) + (size,) * 3, generator=generator)}
+    for key in keys:
+        batch[key] = torch.randint(NUM_CLASSES, (2, 1) + (size,) * 3, generator=generator).float()
+    return batch
+
+
+@pytest.mark.parametrize("keys", [('seg1', 'seg2'), ('seg1',), ('seg2',)])
+def test_seg_losses_availabilities(keys):
+    """
+    seg_losses on label maps, for each segmentation availability, against the one-hot losses, in float32
+    as in training (monai's Warp does not take float64 label maps).
+    """
+    torch.manual_seed(0)
+    seg_net = torch.nn.Conv3d(1, NUM_CLASSES, 3, padding=1)
+    reg_net = Displacement(8, seed=1)
+    batch = availability_batch(keys)
+
+    expected = reference_seg_losses(batch, reg_net, seg_net)
+    sum(expected).backward()
+    expected_grads = [p.grad.clone() for p in seg_net.parameters()]
+    seg_net.zero_grad()
+    result = seg_losses(batch, 'cpu', reg_net, seg_net, NUM_CLASSES)
+    sum(result).backward()
+    for r, e in zip(result, expected):
+        torch.testing.assert_close(r, e, rtol=1e-5, atol=1e-6)
+    for p, e in zip(seg_net.parameters(), expected_grads):
+        torch.testing.assert_close(p.grad, e, rtol=1e-4, atol=1e-6)
+
+
+@pytest.mark.parametrize("keys", [('seg1', 'seg2'), ('seg1',), ('seg2',)])
+def test_masked_seg_losses_availabilities(keys):
+    """ masked_seg_losses on a batch of one pair matches seg_losses, for each segmentation availability. """
+    torch.manual_seed(0)
+    seg_net = torch.nn.Conv3d(1, NUM_CLASSES, 3, padding=1)
+    reg_net = Displacement(8, seed=1)
+    batch = {key: value[:1] for key, value in availability_batch(keys).items()}
+    masked = dict(batch)
+    for key in ('seg1', 'seg2'):
+        masked[key + '_mask'] = torch.tensor([key in batch])
+        if key not in batch:
+            masked[key] = torch.zeros_like(batch['img12'][:, :1])
+    expected = seg_losses(batch, 'cpu', reg_net, seg_net, NUM_CLASSES)
+    result = masked_seg_losses(masked, 'cpu', reg_net, seg_net, NUM_CLASSES)
+    for r, e in zip(result, expected):
+        torch.testing.assert_close(r, e, rtol=1e-5, atol=1e-6)
@@ -0,0 +1,113 @@
+import os
+import sys
+
+import pytest
+import torch
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from lncc import LocalNormalizedCrossCorrelationLoss
+
+
+def pinned_lncc(kernel_size, reduction="mean", smooth_nr=1e-5, smooth_dr=1e-5):
+    """
+    Reference copy of LocalNormalizedCrossCorrelationLoss(spatial_dims=3, kernel_type='rectangular').forward
+    at the pinned monai version (ed233d9), whose formula newer monai versions changed: the window sums are
+    zero padded convolutions with a box kernel, the variances are clamped at 0 and smooth_dr is added to
+    their product.
+    """
+    def loss(pred, target):
+        kernel = torch.ones((1, 1) + (kernel_size,) * 3, dtype=pred.dtype, device=pred.device)
+        kernel_vol = float(kernel_size ** 3)
+
+        def window_sum(x):
+            return torch.nn.functional.conv3d(x, kernel, padding=kernel_size // 2)
+        t2, p2, tp = target * target, pred * pred, target * pred
+        t_sum, p_sum = window_sum(target), window_sum(pred)
+        t2_sum, p2_sum, tp_sum = window_sum(t2), window_sum(p2), window_sum(tp)
+        t_avg = t_sum / kernel_vol
+        p_avg = p_sum / kernel_vol
+        cross = tp_sum - p_avg * t_sum
+        t_var = t2_sum - t_avg * t_sum
+        p_var = p2_sum - p_avg * p_sum
+        t_var = torch.max(t_var, torch.zeros_like(t_var))
+        p_var = torch.max(p_var, torch.zeros_like(p_var))
+        ncc = (cross * cross + smooth_nr) / (t_var * p_var + smooth_dr)
+        if reduction == "sum":
+            return torch.sum(ncc).neg()
+        if reduction == "none":
+            return ncc.neg()
+        return torch.mean(ncc).neg()
+    return loss
+
+
+def lncc(kernel_size, reduction="mean"):
+    return LocalNormalizedCrossCorrelationLoss(
+        spatial_dims=3, kernel_size=kernel_size, reduction=reduction, smooth_nr=1e-5, smooth_dr=1e-5)
+
+
+def zscored_volume(size, shift=0, offset=0., seed=0):
+    """ A textured ellipsoid on a constant background, z-score normalized as by crop.Zscore_normalization. """
+    generator = torch.Generator().manual_seed(seed)
+    grid = torch.stack(torch.meshgrid(*[torch.linspace(-1, 1, size)] * 3, indexing='ij'))
+    foreground = (grid ** 2 / torch.tensor([1., .8, .6]).view(3, 1, 1, 1)).sum(0) < .7
+    volume = torch.where(foreground, 1 + grid[0] + torch.rand((size,) * 3, generator=generator), torch.zeros(()))
+    volume = (volume - volume.mean()) / volume.std()
+    return torch.roll(volume, shift, 0)[None, None] + offset
+
+
+@pytest.mark.parametrize("kernel_size", [3, 5, 9])
+@pytest.mark.parametrize("reduction", ["mean", "none"])
+def test_matches_pinned_float64(kernel_size, reduction):
+    generator = torch.Generator().manual_seed(kernel_size)
+    pred = torch.rand(2, 1, 12, 10, 8, generator=generator, dtype=torch.float64)
+    target = torch.rand(2, 1, 12, 10, 8, generator=generator, dtype=torch.float64)
+    pred_ref, pred_box = pred.clone().requires_grad_(), pred.clone().requires_grad_()
+    expected = pinned_lncc(kernel_size, reduction)(pred_ref, target)
+    result = lncc(kernel_size, reduction)(pred_box, target)
+    torch.testing.assert_close(result, expected, rtol=1e-10, atol=1e-12)
+    expected.sum().backward()
+    result.sum().backward()
+    torch.testing.assert_close(pred_box.grad, pred_ref.grad, rtol=1e-8, atol=1e-14)
+
+
+def test_constant_volumes():
+    # every window is flat, so every voxel contributes smooth_nr / smooth_dr, not smooth_nr / smooth_dr ** 2
+    volume = torch.zeros(1, 1, 8, 8, 8, dtype=torch.float64)
+    torch.testing.assert_close(lncc(3)(volume, volume), torch.tensor(-1., dtype=torch.float64))
+    torch.testing.assert_close(lncc(3)(volume + 3, volume - 2), pinned_lncc(3)(volume + 3, volume - 2))
+
+
+@pytest.mark.parametrize("kernel_size", [3, 5])
+def test_gradcheck(kernel_size):
+    generator = torch.Generator().manual_seed(0)
+    pred = torch.rand(1, 1, 6, 5, 4, generator=generator, dtype=torch.float64, requires_grad=True)
+    target = torch.rand(1, 1, 6, 5, 4, generator=generator, dtype=torch.float64, requires_grad=True)
+    assert torch.autograd.gradcheck(lncc(kernel_size), (pred, target))
+
+
+def float32_gradient_error(loss, pred, target):
+    """ Max error of the float32 gradient of loss with respect to pred, against the pinned monai's in float64. """
+    pred_ref = pred.double().requires_grad_()
+    pinned_lncc(3)(pred_ref, target.double()).backward()
+    pred = pred.clone().requires_grad_()
+    loss(pred, target).backward()
+    return (pred.grad.double() - pred_ref.grad).abs().max().item()
+
+
+@pytest.mark.parametrize("offset", [0., -1000.])
+def test_float32_constant_background(offset):
+    """
+    float32 on z-scored volumes with a constant background, against the pinned monai in float64. The gradient
+    error has to stay within the float32 rounding of the pinned monai itself on the volumes without offset;
+    with an offset of -1000 (as for Hounsfield units), its own float32 gradient is off by orders of magnitude more.
+    """
+    target = zscored_volume(64)
+    pred = zscored_volume(64, shift=2, seed=1)
+    tolerance = 2 * float32_gradient_error(pinned_lncc(3), pred, target)
+
+    target, pred = target + offset, pred + offset
+    expected = pinned_lncc(3)(pred.double(), target.double())
+    result = lncc(3)(pred, target)
+    assert result.dtype == torch.float32
+    torch.testing.assert_close(result.double(), expected, rtol=1e-6, atol=0)
+    assert float32_gradient_error(lncc(3), pred, target) < tolerance
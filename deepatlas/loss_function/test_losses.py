@@ -0,0 +1,102 @@
+import os
+import sys
+
+import monai
+import pytest
+import torch
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from losses import (
+    fill_segmentation, masked_seg_losses, RegistrationLossEngine, reg_losses, masked_reg_losses,
+    lncc_loss_func, regularization_loss_func
+)
+
+
+def networks(num_classes, seed=0):
+    torch.manual_seed(seed)
+    return torch.nn.Conv3d(1, num_classes, 3, padding=1), torch.nn.Conv3d(2, 3, 3, padding=1)
+
+
+def masked_batch(num_classes, size=8, seed=0):
+    """ A batch as collated by masked_label_collate, with the pairs of all four segmentation availabilities. """
+    generator = torch.Generator().manual_seed(seed)
+    shape = (4, 1) + (size,) * 3
+    return {
+        'img12': torch.rand((4, 2) + (size,) * 3, generator=generator),
+        'seg1': torch.randint(num_classes, shape, generator=generator).float(),
+        'seg2': torch.randint(num_classes, shape, generator=generator).float(),
+        'seg1_mask': torch.tensor([False, False, True, True]),
+        'seg2_mask': torch.tensor([False, True, False, True]),
+    }
+
+
+def test_fill_segmentation_bf16_autocast():
+    seg_net, _ = networks(3)
+    batch = masked_batch(3)
+    with torch.autocast('cpu', dtype=torch.bfloat16):
+        seg = fill_segmentation(batch['seg1'], batch['seg1_mask'], batch['img12'][:, [0]], seg_net, 3)
+    assert seg.dtype == torch.float32
+    torch.testing.assert_close(seg[2:], monai.networks.one_hot(batch['seg1'][2:], 3))
+    torch.testing.assert_close(seg[:2].sum(1), torch.ones_like(seg[:2, 0]))
+
+
+def test_masked_losses_bf16_autocast():
+    """ Mixed precision with mixed availability batches, as train_network and find_batch_sizes run them. """
+    seg_net, reg_net = networks(3)
+    batch = masked_batch(3)
+    with torch.autocast('cpu', dtype=torch.bfloat16):
+        loss_sim, loss_reg, loss_ana, _ = RegistrationLossEngine(3, masked=True)(batch, 'cpu', reg_net, seg_net)
+        loss_supervised, loss_anatomy, loss_metric = masked_seg_losses(batch, 'cpu', reg_net, seg_net, 3)
+    for loss in (loss_sim, loss_reg, loss_ana, loss_supervised, loss_anatomy, loss_metric):
+        assert torch.isfinite(loss)
+    (loss_sim + loss_reg + loss_ana + loss_supervised + loss_anatomy).backward()
+    assert all(torch.isfinite(p.grad).all() for p in list(seg_net.parameters()) + list(reg_net.parameters()))
+
+
+def reference_reg_losses(batch, reg_net, seg_net, num_classes, masked, per_sample):
+    """
+    The reg phase losses with a separate monai Warp of the moving image and of the moving segmentation,
+    and the anatomy loss on one-hot or filled-in segmentations with monai's DiceLoss.
+    """
+    warp = monai.networks.blocks.Warp(mode="bilinear", padding_mode="border")
+    reduction = "none" if per_sample else "mean"
+    lncc_loss = lncc_loss_func()
+    lncc_loss.reduction = reduction
+    img12 = batch['img12']
+    displacement_field = reg_net(img12)
+    segs = []
+    for i, key in enumerate(('seg1', 'seg2')):
+        image = img12[:, [i]]
+        if masked:
+            segs.append(fill_segmentation(batch[key], batch[key + '_mask'], image, seg_net, num_classes))
+        elif key in batch:
+            segs.append(monai.networks.one_hot(batch[key], num_classes))
+        else:
+            segs.append(seg_net(image).softmax(dim=1))
+    loss_sim = lncc_loss(warp(img12[:, [1]], displacement_field), img12[:, [0]])
+    loss_ana = monai.losses.DiceLoss(reduction=reduction)(warp(segs[1], displacement_field), segs[0])
+    if per_sample:
+        loss_sim = loss_sim.flatten(start_dim=1).mean(dim=1)
+        loss_ana = loss_ana.flatten(start_dim=1).mean(dim=1)
+    return loss_sim, regularization_loss_func()(displacement_field), loss_ana
+
+
+@pytest.mark.parametrize("keys", [(), ('seg1',), ('seg2',), ('seg1', 'seg2')])
+@pytest.mark.parametrize("per_sample", [False, True])
+def test_reg_losses_availabilities(keys, per_sample):
+    seg_net, reg_net = networks(3)
+    batch = {key: value for key, value in masked_batch(3).items() if key in ('img12',) + keys}
+    expected = reference_reg_losses(batch, reg_net, seg_net, 3, False, per_sample)
+    result = reg_losses(batch, 'cpu', reg_net, seg_net, 3, per_sample=per_sample)
+    for r, e in zip(result, expected):
+        torch.testing.assert_close(r, e, rtol=1e-5, atol=1e-6)
+
+
+@pytest.mark.parametrize("per_sample", [False, True])
+def test_masked_reg_losses(per_sample):
+    seg_net, reg_net = networks(3)
+    batch = masked_batch(3)
+    expected = reference_reg_losses(batch, reg_net, seg_net, 3, True, per_sample)
+    result = masked_reg_losses(batch, 'cpu', reg_net, seg_net, 3, per_sample=per_sample)
+    for r, e in zip(result, expected):
+        torch.testing.assert_close(r, e, rtol=1e-5, atol=1e-6)
@@ -0,0 +1,113 @@
+import os
+import sys
+
+import pytest
+import torch
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from regularization import BendingEnergyLoss
+
+
+def spatial_gradient(x, dim):
+    """ Reference copy of monai.losses.deform.spatial_gradient at the pinned monai version (ed233d9). """
+    slice_1 = slice(1, -1)
+    slice_2_s = slice(2, None)
+    slice_2_e = slice(None, -2)
+    slice_all = slice(None)
+    slicing_s, slicing_e = [slice_all, slice_all], [slice_all, slice_all]
+    while len(slicing_s) < x.ndim:
+        slicing_s = slicing_s + [slice_1]
+        slicing_e = slicing_e + [slice_1]
+    slicing_s[dim] = slice_2_s
+    slicing_e[dim] = slice_2_e
+    return (x[tuple(slicing_s)] - x[tuple(slicing_e)]) / 2.0
+
+
+def pinned_bending_energy(pred, normalize, reduction):
+    """
+    Reference copy of BendingEnergyLoss.forward at the pinned monai version, but with the normalize factors
+    in the dtype of pred rather than in float32, so that float64 comparisons are exact.
+    """
+    first_order_gradient = [spatial_gradient(pred, dim) for dim in range(2, pred.ndim)]
+    if normalize:
+        spatial_dims = torch.tensor(pred.shape[2:], dtype=pred.dtype).reshape((1, -1) + (pred.ndim - 2) * (1,))
+    energy = torch.tensor(0)
+    for dim_1, g in enumerate(first_order_gradient):
+        dim_1 += 2
+        if normalize:
+            g = g * (pred.shape[dim_1] / spatial_dims)
+            energy = energy + (spatial_gradient(g, dim_1) * pred.shape[dim_1]) ** 2
+        else:
+            energy = energy + spatial_gradient(g, dim_1) ** 2
+        for dim_2 in range(dim_1 + 1, pred.ndim):
+            if normalize:
+                energy = energy + 2 * (spatial_gradient(g, dim_2) * pred.shape[dim_2]) ** 2
+            else:
+                energy = energy + 2 * spatial_gradient(g, dim_2) ** 2
+    return reduce(energy, reduction)
+
+
+def compact_bending_energy(pred, normalize, reduction):
+    """
+    Reference for compact=True: the bending energy of newer monai versions, whose pure second derivatives
+    use the [1, -2, 1] stencil and whose output drops one voxel per side.
+    """
+    inner = [slice(None), slice(None)] + [slice(1, -1)] * (pred.ndim - 2)
+
+    def shifted(shifts):
+        index = list(inner)
+        for dim, shift in shifts.items():
+            index[dim] = slice(2, None) if shift > 0 else slice(None, -2)
+        return pred[tuple(index)]
+
+    if normalize:
+        spatial_dims = torch.tensor(pred.shape[2:], dtype=pred.dtype).reshape((1, -1) + (pred.ndim - 2) * (1,))
+    energy = torch.tensor(0)
+    for dim_1 in range(2, pred.ndim):
+        d2 = shifted({dim_1: 1}) - 2 * pred[tuple(inner)] + shifted({dim_1: -1})
+        if normalize:
+            d2 = d2 * (pred.shape[dim_1] ** 2 / spatial_dims)
+        energy = energy + d2 ** 2
+        for dim_2 in range(dim_1 + 1, pred.ndim):
+            d2_mixed = (shifted({dim_1: 1, dim_2: 1}) - shifted({dim_1: 1, dim_2: -1})
+                        - shifted({dim_1: -1, dim_2: 1}) + shifted({dim_1: -1, dim_2: -1})) / 4
+            if normalize:
+                d2_mixed = d2_mixed * (pred.shape[dim_1] * pred.shape[dim_2] / spatial_dims)
+            energy = energy + 2 * d2_mixed ** 2
+    return reduce(energy, reduction)
+
+
+def reduce(energy, reduction):
+    if reduction == "mean":
+        return torch.mean(energy)
+    if reduction == "sum":
+        return torch.sum(energy)
+    return energy
+
+
+@pytest.mark.parametrize("shape", [(2, 3, 9, 8, 7), (2, 2, 9, 7)])
+@pytest.mark.parametrize("reduction", ["mean", "sum", "none"])
+@pytest.mark.parametrize("normalize", [False, True])
+@pytest.mark.parametrize("compact", [False, True])
+def test_matches_reference(shape, reduction, normalize, compact):
+    generator = torch.Generator().manual_seed(len(shape))
+    pred = torch.randn(shape, generator=generator, dtype=torch.float64)
+    pred_ref, pred_sep = pred.clone().requires_grad_(), pred.clone().requires_grad_()
+    reference = compact_bending_energy if compact else pinned_bending_energy
+    expected = reference(pred_ref, normalize, reduction)
+    result = BendingEnergyLoss(normalize=normalize, reduction=reduction, compact=compact)(pred_sep)
+    assert result.shape == expected.shape
+    torch.testing.assert_close(result, expected, rtol=1e-10, atol=1e-12)
+    weights = torch.rand(expected.shape, generator=generator, dtype=torch.float64)
+    (expected * weights).sum().backward()
+    (result * weights).sum().backward()
+    torch.testing.assert_close(pred_sep.grad, pred_ref.grad, rtol=1e-10, atol=1e-12)
+
+
+@pytest.mark.parametrize("reduction", ["mean", "sum", "none"])
+@pytest.mark.parametrize("compact", [False, True])
+def test_gradcheck(reduction, compact):
+    generator = torch.Generator().manual_seed(0)
+    pred = torch.randn(1, 3, 6, 5, 7, generator=generator, dtype=torch.float64, requires_grad=True)
+    loss = BendingEnergyLoss(normalize=True, reduction=reduction, compact=compact)
+    assert torch.autograd.gradcheck(loss, (pred,))
@@ -54,3 +54,60 @@ def regNet(
         num_res_units=num_res_unit
     )
     return reg_net
+
+
+def unet_levels(unet):
+    """
+    The levels of a monai UNet from the top (full resolution) down, each a Sequential of
+    (encoder block, SkipConnection, decoder block), and the bottom block.
+    """
+    levels = []
+    module = unet.model
+    while isinstance(module, torch.nn.Sequential) and len(module) == 3 and \
+            isinstance(module[1], monai.networks.layers.SkipConnection):
+        levels.append(module)
+        module = module[1].submodule
+    return levels, module
+
+
+def checkpoint_module(module):
+    """
+    Make module recompute its activations in the backward pass instead of storing them, while training.
+    Only the forward method is replaced, so the parameters and the state_dict keys are unchanged.
+    """
+    forward = module.forward
+
+    def checkpointed_forward(x):
+        if module.training and torch.is_grad_enabled():
+            return torch.utils.checkpoint.checkpoint(forward, x, use_reentrant=False)
+        return forward(x)
+    module.forward = checkpointed_forward
+    return module
+
+
+def checkpoint_unet(unet, granularity='block', levels=None):
+    """
+    Apply activation checkpointing to a monai UNet, trading compute for activation memory.
+
+    granularity 'block' checkpoints the encoder and decoder blocks of the top `levels` levels
+    (all levels and the bottom block if levels is None); the high resolution levels hold most of the memory.
+    granularity 'level' checkpoints everything below the top `levels` levels as one segment
+    (the whole network if levels is None), which saves more memory but recomputes in one go.
+    Gradients are unchanged; with batch normalization the running statistics see the recomputed
+    forward passes as extra updates.
+    """
+    unet_levels_, bottom = unet_levels(unet)
+    if granularity == 'block':
+        for level in unet_levels_[:levels]:
+            checkpoint_module(level[0])
+            checkpoint_module(level[2])
+        if levels is None or levels > len(unet_levels_):
+            checkpoint_module(bottom)
+    elif granularity == 'level':
+        if levels is None or levels == 0:
+            checkpoint_module(unet.model)
+        else:
+            checkpoint_module(unet_levels_[min(levels, len(unet_levels_)) - 1][1])
+    else:
+        raise ValueError(f"unknown checkpointing granularity {granularity}, expected 'block' or 'level'")
+    return unet
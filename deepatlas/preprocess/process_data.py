@@ -4,6 +4,11 @@ import itk
 import numpy as np
 import glob
 import os
+from volume_cache import (
+    VolumeCache, VolumeCacheDataset
+)
+
+DEFAULT_CACHE_BYTES = 8 * 1024 ** 3
 
 
 def path_to_id(path):
@@ -61,65 +66,36 @@ def split_data(img_path, seg_path, num_seg):
     return train, test, num_train, num_test
 
 
-def load_seg_dataset(train, valid):
-    transform_seg_available = monai.transforms.Compose(
-        transforms=[
-            monai.transforms.LoadImageD(keys=['img', 'seg'], image_only=True),
-            monai.transforms.AddChannelD(keys=['img', 'seg']),
-            monai.transforms.SpacingD(keys=['img', 'seg'], pixdim=(1., 1., 1.), mode=('trilinear', 'nearest')),
-            monai.transforms.ToTensorD(keys=['img', 'seg'])
-        ]
-    )
-    itk.ProcessObject.SetGlobalWarningDisplay(False)
-    dataset_seg_available_train = monai.data.CacheDataset(
-        data=train,
-        transform=transform_seg_available,
-        cache_num=16,
-        hash_as_key=True
-    )
-
-    dataset_seg_available_valid = monai.data.CacheDataset(
-        data=valid,
-        transform=transform_seg_available,
-        cache_num=16,
-        hash_as_key=True
-    )
+def load_seg_dataset(train, valid, cache=None):
+    """
+    Build the segmentation train/valid datasets, serving volumes from cache.
+    If no cache is given, a VolumeCache with the default memory budget is created.
+    """
+    if cache is None:
+        cache = VolumeCache(DEFAULT_CACHE_BYTES)
+    dataset_seg_available_train = VolumeCacheDataset(train, cache)
+    dataset_seg_available_valid = VolumeCacheDataset(valid, cache)
     return dataset_seg_available_train, dataset_seg_available_valid
 
 
-def load_reg_dataset(train, valid):
-    transform_pair = monai.transforms.Compose(
-        transforms=[
-            monai.transforms.LoadImageD(
-                keys=['img1', 'seg1', 'img2', 'seg2'], image_only=True, allow_missing_keys=True),
-            monai.transforms.ToTensorD(
-                keys=['img1', 'seg1', 'img2', 'seg2'], allow_missing_keys=True),
-            monai.transforms.AddChannelD(
-                keys=['img1', 'seg1', 'img2', 'seg2'], allow_missing_keys=True),
-            monai.transforms.SpacingD(keys=['img1', 'seg1', 'img2', 'seg2'], pixdim=(1., 1., 1.), mode=(
-                'trilinear', 'nearest', 'trilinear', 'nearest'), allow_missing_keys=True),
-            monai.transforms.ConcatItemsD(
-                keys=['img1', 'img2'], name='img12', dim=0),
-            monai.transforms.DeleteItemsD(keys=['img1', 'img2'])
-        ]
-    )
+def load_reg_dataset(train, valid, cache=None):
+    """
+    Build the registration train/valid datasets for each segmentation availability,
+    serving volumes from cache. Pairs sharing a scan share its cache entry.
+    If no cache is given, a VolumeCache with the default memory budget is created.
+    If train and valid are StreamingDataPairs, a single dataset over all their pairs is built for each.
+    """
+    if cache is None:
+        cache = VolumeCache(DEFAULT_CACHE_BYTES)
+    if isinstance(train, StreamingDataPairs):
+        return VolumeCacheDataset(train, cache), VolumeCacheDataset(valid, cache)
     dataset_pairs_train_subdivided = {
-        seg_availability: monai.data.CacheDataset(
-            data=data_list,
-            transform=transform_pair,
-            cache_num=32,
-            hash_as_key=True
-        )
+        seg_availability: VolumeCacheDataset(data_list, cache)
         for seg_availability, data_list in train.items()
     }
 
     dataset_pairs_valid_subdivided = {
-        seg_availability: monai.data.CacheDataset(
-            data=data_list,
-            transform=transform_pair,
-            cache_num=32,
-            hash_as_key=True
-        )
+        seg_availability: VolumeCacheDataset(data_list, cache)
         for seg_availability, data_list in valid.items()
     }
     return dataset_pairs_train_subdivided, dataset_pairs_valid_subdivided
@@ -162,3 +138,49 @@ def subdivide_list_of_data_pairs(data_pairs_list):
         else:
             out_dict['00'].append(d)
     return out_dict
+
+
+class StreamingDataPairs:
+    """
+    The data pairs of take_data_pairs(data, symmetric=True), subdivided by segmentation availability
+    like subdivide_list_of_data_pairs, without materializing them.
+
+    The pair of data[i] (target) and data[j] (moving) is addressed by the index i * len(data) + j and
+    built on demand, so memory stays linear in the number of scans. Indices with i == j do not
+    address a pair; use index_arrays to draw valid pairs of a given segmentation availability.
+    """
+
+    def __init__(self, data):
+        self.data = data
+        self.labeled = np.array([k for k, d in enumerate(data) if 'seg' in d.keys()], dtype=np.int64)
+        self.unlabeled = np.array([k for k, d in enumerate(data) if 'seg' not in d.keys()], dtype=np.int64)
+
+    def __len__(self):
+        return len(self.data) ** 2
+
+    def __getitem__(self, index):
+        i, j = divmod(int(index), len(self.data))
+        d1 = self.data[i]
+        d2 = self.data[j]
+        pair = {
+            'img1': d1['img'],
+            'img2': d2['img']
+        }
+        if 'seg' in d1.keys():
+            pair['seg1'] = d1['seg']
+        if 'seg' in d2.keys():
+            pair['seg2'] = d2['seg']
+        return pair
+
+    def index_arrays(self, seg_availability):
+        """ The indices into data of the target and moving scans of the pairs with seg_availability. """
+        first = self.labeled if seg_availability[0] == '1' else self.unlabeled
+        second = self.labeled if seg_availability[1] == '1' else self.unlabeled
+        return first, second
+
+    def num_pairs(self, seg_availability):
+        first, second = self.index_arrays(seg_availability)
+        if first is second:
+            return len(first) * (len(first) - 1)
+        return len(first) * len(second)
+
@@ -0,0 +1,374 @@
+import monai
+import torch
+import itk
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict, namedtuple
+
+try:
+    import blosc
+except ImportError:
+    blosc = None
+
+IMAGE_KEYS = ('img', 'img1', 'img2')
+LABEL_KEYS = ('seg', 'seg1', 'seg2')
+COMPACT_IMAGE_DTYPES = {
+    'float16': torch.float16,
+    'bfloat16': torch.bfloat16
+}
+COMPACT_STORAGE_DTYPES = (torch.float16, torch.bfloat16, torch.uint8, torch.int16)
+
+CompressedVolume = namedtuple('CompressedVolume', ['data', 'shape', 'dtype'])
+
+
+def volume_transform(mode):
+    """
+    Load a single volume from disk, add the channel dimension and respace it to 1mm isotropic.
+    mode is the interpolation mode used by SpacingD ('trilinear' for scans, 'nearest' for labels).
+    """
+    return monai.transforms.Compose(
+        transforms=[
+            monai.transforms.LoadImageD(keys=['vol'], image_only=True),
+            monai.transforms.AddChannelD(keys=['vol']),
+            monai.transforms.SpacingD(keys=['vol'], pixdim=(1., 1., 1.), mode=mode),
+            monai.transforms.ToTensorD(keys=['vol'])
+        ]
+    )
+
+
+def volume_kind(key):
+    if key in IMAGE_KEYS:
+        return 'image'
+    if key in LABEL_KEYS:
+        return 'label'
+    return None
+
+
+def tensor_nbytes(tensor):
+    return tensor.element_size() * tensor.nelement()
+
+
+def compact_volume(volume, kind, image_dtype):
+    """
+    Cast a volume to its compact storage dtype: labels to uint8 (int16 if they do not fit),
+    images to image_dtype (float16 or bfloat16).
+    """
+    if kind == 'label':
+        return volume.to(torch.uint8 if volume.max() <= 255 else torch.int16)
+    return volume.to(image_dtype)
+
+
+def compress_volume(volume, cname):
+    """
+    Compress a volume with blosc, byte-shuffled so that the slowly varying high bytes compress well.
+    """
+    volume = volume.detach().cpu().contiguous()
+    data = blosc.compress_ptr(volume.data_ptr(), volume.nelement(), typesize=volume.element_size(),
+                              cname=cname, shuffle=blosc.SHUFFLE)
+    return CompressedVolume(data, tuple(volume.shape), volume.dtype)
+
+
+def decompress_volume(compressed):
+    volume = torch.empty(compressed.shape, dtype=compressed.dtype)
+    blosc.decompress_ptr(compressed.data, volume.data_ptr())
+    return volume
+
+
+def upcast_collate(batch):
+    """
+    Collate a list of data items and upcast volumes stored in a compact dtype back to float32,
+    so that the upcast is done once per batch rather than once per cached volume.
+    """
+    batch = monai.data.list_data_collate(batch)
+    for key, value in batch.items():
+        if torch.is_tensor(value) and value.dtype in COMPACT_STORAGE_DTYPES:
+            batch[key] = value.float()
+    return batch
+
+
+def masked_label_collate(batch):
+    """
+    Collate data pairs with different segmentation availabilities into one batch.
+    A missing 'seg1'/'seg2' is replaced by an all-background placeholder, and the boolean
+    'seg1_mask'/'seg2_mask' of shape (B,) tell which samples have ground truth.
+    """
+    label_dtype = next((item[key].dtype for item in batch for key in ('seg1', 'seg2') if key in item), torch.uint8)
+    padded = []
+    for item in batch:
+        item = dict(item)
+        for key in ('seg1', 'seg2'):
+            item[key + '_mask'] = torch.tensor(key in item)
+            if key not in item:
+                item[key] = torch.zeros_like(item['img12'][:1], dtype=label_dtype)
+        padded.append(item)
+    return upcast_collate(padded)
+
+
+class VolumeCache:
+    """
+    In-memory cache of preprocessed volumes keyed by file path, bounded by a memory budget in bytes.
+
+    Volumes are evicted in least-recently-used order once the budget is exceeded. Because the cache is
+    keyed by volume rather than by data item, all the pairs that share a scan also share its cache entry.
+    The cache lives in the main process and is thread-safe, so it is meant to be served through
+    monai.data.ThreadDataLoader rather than multi-process workers, which would each hold a private copy.
+
+    If compact_dtype is 'float16' or 'bfloat16', scans are stored in that dtype and labels as uint8;
+    use upcast_collate as the collate_fn of the dataloaders to get float32 batches back.
+
+    If compression is a blosc codec name (e.g. 'lz4'), volumes are stored compressed and the budget
+    applies to the compressed size. Decompression runs on compression_threads blosc threads.
+    This needs python-blosc (blosc in requirements.txt); without it a compressed cache raises an ImportError.
+
+    warm() fills the cache from a background thread pool while training draws from it; a volume that
+    is requested while it is being warmed is waited for rather than loaded twice.
+    """
+
+    def __init__(self, max_bytes, compact_dtype=None, compression=None, compression_threads=4):
+        self.max_bytes = int(max_bytes)
+        if compact_dtype is not None and compact_dtype not in COMPACT_IMAGE_DTYPES:
+            raise ValueError(
+                f"Invalid value '{compact_dtype}' given for compact_dtype, expected one of {list(COMPACT_IMAGE_DTYPES)}")
+        self.compact_dtype = compact_dtype
+        if compression is not None:
+            if blosc is None:
+                raise ImportError('python-blosc is required for a compressed volume cache, '
+                                  'install it with `pip install blosc`')
+            if compression not in blosc.cnames:
+                raise ValueError(
+                    f"Invalid value '{compression}' given for compression, expected one of {blosc.cnames}")
+            blosc.set_nthreads(compression_threads)
+        self.compression = compression
+        self.current_bytes = 0
+        self.raw_bytes = 0
+        self.decompressions = 0
+        self.decompress_seconds = 0.
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._loading = {}
+        self._lock = threading.Lock()
+        self.warm_total = 0
+        self.warm_done = 0
+        self._warm_stopped = False
+        self._transforms = {
+            'image': volume_transform('trilinear'),
+            'label': volume_transform('nearest')
+        }
+        itk.ProcessObject.SetGlobalWarningDisplay(False)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, path, kind='image'):
+        """
+        Return the preprocessed volume stored at path, loading it on a cache miss.
+        kind is 'image' or 'label' and selects the interpolation used for respacing.
+        The returned tensor is shared with the cache and must not be modified in place.
+        """
+        key = (path, kind)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+            else:
+                self.misses += 1
+        if entry is not None:
+            return self._unpack(entry[0])
+        return self._load(key)[0]
+
+    def _read(self, key):
+        path, kind = key
+        # metadata is not needed downstream; a plain tensor keeps hits and misses interchangeable
+        volume = torch.as_tensor(self._transforms[kind]({'vol': path})['vol']).as_subclass(torch.Tensor)
+        if self.compact_dtype is not None:
+            volume = compact_volume(volume, kind, COMPACT_IMAGE_DTYPES[self.compact_dtype])
+        return volume
+
+    def _load(self, key, evict=True):
+        """
+        Read the volume for key and insert it into the cache, or wait for it if another thread
+        is already reading it. Returns the volume and whether it is now in the cache.
+        """
+        with self._lock:
+            event = self._loading.get(key)
+            if event is None:
+                event = self._loading[key] = threading.Event()
+                owner = True
+            else:
+                owner = False
+        if not owner:
+            event.wait()
+            with self._lock:
+                entry = self._entries.get(key)
+            if entry is not None:
+                return self._unpack(entry[0]), True
+            # the other reader failed or the volume did not fit, read it ourselves
+            volume = self._read(key)
+            return volume, self._insert(key, volume, evict)
+        try:
+            volume = self._read(key)
+            inserted = self._insert(key, volume, evict)
+        finally:
+            with self._lock:
+                del self._loading[key]
+            event.set()
+        return volume, inserted
+
+    def _unpack(self, stored):
+        if not isinstance(stored, CompressedVolume):
+            return stored
+        start = time.perf_counter()
+        volume = decompress_volume(stored)
+        elapsed = time.perf_counter() - start
+        with self._lock:
+            self.decompressions += 1
+            self.decompress_seconds += elapsed
+        return volume
+
+    def _insert(self, key, volume, evict=True):
+        """
+        Store volume under key, evicting least recently used volumes if evict is set.
+        Returns whether key is in the cache afterwards.
+        """
+        raw_nbytes = tensor_nbytes(volume)
+        if self.compression is not None:
+            stored = compress_volume(volume, self.compression)
+            nbytes = len(stored.data)
+        else:
+            stored = volume
+            nbytes = raw_nbytes
+        with self._lock:
+            if key in self._entries:
+                return True
+            if nbytes > self.max_bytes:
+                return False
+            if not evict and self.current_bytes + nbytes > self.max_bytes:
+                return False
+            while self.current_bytes + nbytes > self.max_bytes:
+                _, (_, evicted_nbytes, evicted_raw_nbytes) = self._entries.popitem(last=False)
+                self.current_bytes -= evicted_nbytes
+                self.raw_bytes -= evicted_raw_nbytes
+                self.evictions += 1
+            self._entries[key] = (stored, nbytes, raw_nbytes)
+            self.current_bytes += nbytes
+            self.raw_bytes += raw_nbytes
+        return True
+
+    def warm(self, data_lists, num_threads=4, logger=None):
+        """
+        Start loading every volume referenced by the data items in data_lists on a background pool
+        of num_threads threads and return immediately. Warming never evicts: it stops once the
+        memory budget is full. Progress is reported through logger every 10% if one is given.
+        """
+        keys = []
+        seen = set()
+        for data_list in data_lists:
+            for data_item in data_list:
+                for key, path in data_item.items():
+                    kind = volume_kind(key)
+                    if kind is not None and (path, kind) not in seen:
+                        seen.add((path, kind))
+                        keys.append((path, kind))
+        self.warm_total = len(keys)
+        self.warm_done = 0
+        self._warm_stopped = False
+        if len(keys) == 0:
+            return
+        report_every = max(1, len(keys) // 10)
+        executor = ThreadPoolExecutor(max_workers=num_threads, thread_name_prefix='volume_cache_warm')
+        for key in keys:
+            executor.submit(self._warm_one, key, report_every, logger)
+        executor.shutdown(wait=False)
+
+    def _warm_one(self, key, report_every, logger):
+        try:
+            if self._warm_stopped:
+                return
+            with self._lock:
+                cached = key in self._entries
+            if not cached and not self._load(key, evict=False)[1] and not self._warm_stopped:
+                self._warm_stopped = True
+                if logger is not None:
+                    logger.info(f"volume cache warming stopped, memory budget is full: {self.summary()}")
+        finally:
+            with self._lock:
+                self.warm_done += 1
+                done = self.warm_done
+            if logger is not None and not self._warm_stopped and (done % report_every == 0 or done == self.warm_total):
+                logger.info(f"volume cache warming: {done}/{self.warm_total} volumes")
+
+    def stop_warming(self):
+        """Skip the volumes that are still queued for warming."""
+        self._warm_stopped = True
+
+    def compression_ratio(self):
+        return self.raw_bytes / self.current_bytes if self.current_bytes > 0 else 1.
+
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / total if total > 0 else 0.
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'hit_rate': self.hit_rate(),
+            'num_volumes': len(self._entries),
+            'current_bytes': self.current_bytes,
+            'raw_bytes': self.raw_bytes,
+            'max_bytes': self.max_bytes,
+            'compression_ratio': self.compression_ratio(),
+            'decompressions': self.decompressions,
+            'decompress_seconds': self.decompress_seconds
+        }
+
+    def reset_stats(self):
+        with self._lock:
+            self.hits = 0
+            self.misses = 0
+            self.evictions = 0
+            self.decompressions = 0
+            self.decompress_seconds = 0.
+
+    def summary(self):
+        summary = (f"{self.hits} hits, {self.misses} misses, {self.evictions} evictions "
+                   f"(hit rate {self.hit_rate():.1%}), {len(self._entries)} volumes, "
+                   f"{self.current_bytes / 1024 ** 3:.2f}/{self.max_bytes / 1024 ** 3:.2f} GiB")
+        if self.warm_done < self.warm_total:
+            summary += f", warmed {self.warm_done}/{self.warm_total} volumes"
+        if self.compression is not None:
+            mean_ms = 1000 * self.decompress_seconds / max(self.decompressions, 1)
+            summary += (f", {self.compression} compression ratio {self.compression_ratio():.2f}, "
+                        f"{mean_ms:.1f} ms per decompression")
+        return summary
+
+
+class VolumeCacheDataset(torch.utils.data.Dataset):
+    """
+    Dataset over a list of dicts of file paths ('img'/'seg' or 'img1'/'seg1'/'img2'/'seg2'),
+    serving every volume from a shared VolumeCache.
+    For pair items, the two scans are concatenated along the channel dimension into 'img12'.
+    """
+
+    def __init__(self, data, cache):
+        self.data = data
+        self.cache = cache
+
+    def __len__(self):
+        return len(self.data)
+
+    def __getitem__(self, index):
+        data_item = self.data[index]
+        item = {}
+        for key, path in data_item.items():
+            kind = volume_kind(key)
+            if kind is not None:
+                item[key] = self.cache.get(path, kind)
+        if 'img1' in item and 'img2' in item:
+            item['img12'] = torch.cat([item.pop('img1'), item.pop('img2')], dim=0)
+        return item
@@ -0,0 +1,112 @@
+import torch
+import os.path
+import argparse
+import sys
+import logging
+from pathlib import Path
+from collections import namedtuple
+import deep_atlas_train
+
+ROOT_DIR = str(Path(os.getcwd()).parent.parent.absolute())
+sys.path.insert(0, os.path.join(ROOT_DIR, 'deepatlas/train'))
+sys.path.insert(0, os.path.join(ROOT_DIR, 'deepatlas/loss_function'))
+sys.path.insert(0, os.path.join(ROOT_DIR, 'deepatlas/utils'))
+from batch_size_finder import (
+    synthetic_pair_batch, time_step
+)
+from batch_transforms import ChannelsLast
+from losses import (
+    RegistrationLossEngine, seg_losses, masked_seg_losses
+)
+from train import swap_training
+from utils import load_json
+
+
+def parse_command_line():
+    parser = argparse.ArgumentParser(
+        description='benchmark the training steps of seg_net and reg_net in the default and channels_last_3d layouts')
+    parser.add_argument('--config', metavar='path to the configuration file', type=str,
+                        help='absolute path to the configuration file')
+    parser.add_argument('-rs', metavar='shape after resizing', type=int, nargs='+',
+                        help='the crop shape of the volumes')
+    parser.add_argument('-nl', metavar='number of labels', type=int, default=4,
+                        help='the number of segmentation classes, background included')
+    parser.add_argument('-bs', metavar='batch size', type=int, default=1,
+                        help='the number of pairs per step')
+    parser.add_argument('-ns', metavar='number of steps', type=int, default=10,
+                        help='the number of timed steps of each phase')
+    parser.add_argument('--cpu', action='store_true',
+                        help='benchmark on cpu even if cuda is available')
+    argv = parser.parse_args()
+    return argv
+
+
+def benchmark(config, shape, num_label, batch_size, num_steps, device, channels_last):
+    """
+    Seconds per reg phase and seg phase training step, in the given layout, with the losses of train_network
+    (the masked ones if the data section of config sets mixed_availability_batches).
+    """
+    network = config.network
+    mixed_availability_batches = getattr(config, 'data', {}).get('mixed_availability_batches', False)
+    reg_losses_func = RegistrationLossEngine(num_label, masked=mixed_availability_batches)
+    seg_losses_func = masked_seg_losses if mixed_availability_batches else seg_losses
+    seg_net = deep_atlas_train.get_seg_net(network['spatial_dim'], num_label, network['dropout'],
+                                           network['activation_type'], network['normalization_type'],
+                                           network['num_res']).to(device)
+    reg_net = deep_atlas_train.get_reg_net(network['spatial_dim'], network['spatial_dim'], network['dropout'],
+                                           network['activation_type'], network['normalization_type'],
+                                           network['num_res']).to(device)
+    optimizer_reg = torch.optim.Adam(reg_net.parameters())
+    optimizer_seg = torch.optim.Adam(seg_net.parameters())
+    reg_batch = synthetic_pair_batch(batch_size, shape, num_label, device, with_segs=False,
+                                     masked=mixed_availability_batches)
+    seg_batch = synthetic_pair_batch(batch_size, shape, num_label, device, with_segs=True,
+                                     masked=mixed_availability_batches)
+    if channels_last:
+        seg_net = seg_net.to(memory_format=torch.channels_last_3d)
+        reg_net = reg_net.to(memory_format=torch.channels_last_3d)
+        reg_batch = ChannelsLast()(reg_batch)
+        seg_batch = ChannelsLast()(seg_batch)
+
+    def reg_step():
+        optimizer_reg.zero_grad()
+        loss_sim, loss_reg, loss_ana, _ = reg_losses_func(reg_batch, device, reg_net, seg_net, num_label)
+        (loss_sim + loss_reg + loss_ana).backward()
+        optimizer_reg.step()
+
+    def seg_step():
+        optimizer_seg.zero_grad()
+        loss_supervised, loss_anatomy, _ = seg_losses_func(seg_batch, device, reg_net, seg_net, num_label)
+        (loss_supervised + loss_anatomy).backward()
+        optimizer_seg.step()
+
+    swap_training(reg_net, seg_net)
+    reg_seconds, _ = time_step(reg_step, num_steps, device)
+    swap_training(seg_net, reg_net)
+    seg_seconds, _ = time_step(seg_step, num_steps, device)
+    return reg_seconds, seg_seconds
+
+
+def main():
+    args = parse_command_line()
+    config = load_json(args.config)
+    config = namedtuple("config", config.keys())(*config.values())
+    if torch.cuda.is_available() and not args.cpu:
+        device = torch.device("cuda:" + str(torch.cuda.current_device()))
+    else:
+        device = torch.device("cpu")
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    logger = logging.getLogger('benchmark')
+    logger.info(f'{device}, crop shape {tuple(args.rs)}, {args.bs} pairs per step')
+    results = {}
+    for channels_last in (False, True):
+        layout = 'channels_last_3d' if channels_last else 'contiguous'
+        results[layout] = benchmark(config, args.rs, args.nl, args.bs, args.ns, device, channels_last)
+        logger.info(f'{layout}: reg step {results[layout][0] * 1000:.1f} ms, seg step {results[layout][1] * 1000:.1f} ms')
+    for phase, i in (('reg', 0), ('seg', 1)):
+        speedup = results['contiguous'][i] / results['channels_last_3d'][i]
+        logger.info(f'{phase} step speedup with channels_last_3d: {speedup:.2f}x')
+
+
+if __name__ == '__main__':
+    main()
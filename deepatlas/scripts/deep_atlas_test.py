@@ -13,11 +13,18 @@ from collections import namedtuple
 ROOT_DIR = str(Path(os.getcwd()).parent.parent.absolute())
 sys.path.insert(0, os.path.join(ROOT_DIR, 'deepatlas/test'))
 sys.path.insert(0, os.path.join(ROOT_DIR, 'deepatlas/utils'))
+sys.path.insert(0, os.path.join(ROOT_DIR, 'deepatlas/preprocess'))
 from test import (
     seg_training_inference, reg_training_inference
 )
 from utils import (
-    make_if_dont_exist, load_json
+    make_if_dont_exist, load_json, setup_device
+)
+from process_data import (
+    DEFAULT_CACHE_BYTES
+)
+from volume_cache import (
+    VolumeCache
 )
 
 def parse_command_line():
@@ -41,10 +48,11 @@ def main():
     config = namedtuple("config", config.keys())(*config.values())
     if len(config.info_name.split('_')) <= 1 or not train_only:
         task = config.task_name
-        if torch.cuda.is_available():
-            device = torch.device("cuda:" + str(torch.cuda.current_device()))
+        device, device_summary = setup_device(getattr(config, 'backend', None))
+        print(device_summary)
         output_path = os.path.join(ROOT_DIR, 'deepatlas_results', task, f'set_{config.exp_set}',f'{config.num_seg_used}gt', config.folder_name, 'training_predicted_results')
         make_if_dont_exist(output_path)
+        data_config = getattr(config, 'data', {})
         
         for i in range(1, config.num_fold+1):
             num_fold = f'fold_{i}'
@@ -71,8 +79,14 @@ def main():
                 spatial_dim, num_label, dropout, activation_type, normalization_type, num_res)
             reg_net = deep_atlas_train.get_reg_net(
                 spatial_dim, spatial_dim, dropout, activation_type, normalization_type, num_res)
-            seg_training_inference(seg_net, device, seg_model_path, seg_path, num_label, json_path=json_path, data=None)
-            reg_training_inference(reg_net, device, reg_model_path, reg_path, num_label, json_path=json_path, data=None)
+            # the test scans are shared by the seg inference and all the reg pairs; compact dtypes
+            # are not used here because items are fed to the networks without collation
+            volume_cache = VolumeCache(data_config.get('cache_bytes', DEFAULT_CACHE_BYTES),
+                                       compression=data_config.get('compression', None),
+                                       compression_threads=data_config.get('compression_threads', 4))
+            seg_training_inference(seg_net, device, seg_model_path, seg_path, num_label, json_path=json_path, data=None, cache=volume_cache)
+            reg_training_inference(reg_net, device, reg_model_path, reg_path, num_label, json_path=json_path, data=None, cache=volume_cache)
+            print(f'{num_fold} volume cache: {volume_cache.summary()}')
     else:
         print('train only, test will be done in the future !!!')
 
@@ -12,16 +12,23 @@ import glob
 
 ROOT_DIR = str(Path(os.getcwd()).parent.parent.absolute())
 sys.path.insert(0, os.path.join(ROOT_DIR, 'deepatlas/test'))
+sys.path.insert(0, os.path.join(ROOT_DIR, 'deepatlas/utils'))
 
 from test import (
     seg_training_inference, load_json, reg_training_inference
 )
+from utils import (
+    setup_device
+)
 
 def parse_command_line():
     parser = argparse.ArgumentParser(
         description='pipeline for deep atlas test')
     parser.add_argument('-gpu', metavar='id of gpu', type=str, default='0',
                         help='id of gpu device to use')
+    parser.add_argument('-config', metavar='path to the configuration file', type=str, default=None,
+                        help='absolute path to the configuration file, whose backend section selects the device '
+                             'and cpu threads as in deep_atlas_train and deep_atlas_test; the default backend if not given')
     parser.add_argument('-ti', metavar='task id and name', type=str,
                         help='task name and id')
     parser.add_argument('-nf', metavar='number of fold', type=int,
@@ -60,7 +67,9 @@ def main():
     activation_type = network_info['activation_type']
     normalization_type = network_info['normalization_type']
     num_res = network_info['num_res']
-    device = torch.device("cuda:" + gpu)
+    backend = load_json(args.config).get('backend', None) if args.config is not None else None
+    device, device_summary = setup_device(backend, gpu=gpu)
+    print(device_summary)
     output_seg_path = os.path.join(out_path, 'SegNet')
     output_reg_path = os.path.join(out_path, 'RegNet')
     try:
@@ -24,14 +24,20 @@ sys.path.insert(0, os.path.join(ROOT_DIR, 'deepatlas/utils'))
 from train import (
     train_network
 )
+from batch_size_finder import find_batch_sizes
+from generators import batch_loader
 from network import (
     regNet, segNet
 )
 from process_data import (
-    split_data, load_seg_dataset, load_reg_dataset, take_data_pairs, subdivide_list_of_data_pairs
+    split_data, load_seg_dataset, load_reg_dataset, take_data_pairs, subdivide_list_of_data_pairs,
+    StreamingDataPairs, DEFAULT_CACHE_BYTES
+)
+from volume_cache import (
+    VolumeCache, upcast_collate
 )
 from utils import (
-    load_json, make_if_dont_exist
+    load_json, make_if_dont_exist, setup_device
 )
 
 def parse_command_line():
@@ -196,8 +202,6 @@ def main():
         info_name = 'info'
     info_path = os.path.join(base_path, config.task_name, 'Training_dataset', 'data_info', folder_name, info_name+'.json')
     info = load_json(info_path)
-    if torch.cuda.is_available():
-        device = torch.device("cuda:" + str(torch.cuda.current_device()))
     
     spatial_dim = config.network['spatial_dim']
     dropout = config.network['dropout']
@@ -211,6 +215,39 @@ def main():
     lam_re = config.network["regularization_loss_weight"]
     max_epoch = config.network["number_epoch"]
     val_step = config.network["validation_step"]
+    mixed_precision = config.network.get("mixed_precision", None)
+    activation_checkpointing = config.network.get("activation_checkpointing", None)
+    compile_options = config.network.get("compile", None)
+    channels_last = config.network.get("channels_last", False)
+    data_config = getattr(config, 'data', {})
+    cache_bytes = data_config.get('cache_bytes', DEFAULT_CACHE_BYTES)
+    compact_dtype = data_config.get('compact_dtype', None)
+    compression = data_config.get('compression', None)
+    compression_threads = data_config.get('compression_threads', 4)
+    warm_threads = data_config.get('warm_threads', 4)
+    prefetch_batches = data_config.get('prefetch_batches', 2)
+    load_threads = data_config.get('load_threads', 4)
+    batch_size_train_reg = data_config.get('batch_size_train_reg', 1)
+    batch_size_valid_reg = data_config.get('batch_size_valid_reg', 2)
+    batch_size_train_seg = data_config.get('batch_size_train_seg', None)
+    batch_size_valid_seg = data_config.get('batch_size_valid_seg', 4)
+    auto_batch_size = data_config.get('auto_batch_size', None)
+    accumulation_steps_reg = data_config.get('accumulation_steps_reg', 1)
+    accumulation_steps_seg = data_config.get('accumulation_steps_seg', 1)
+    mixed_availability_batches = data_config.get('mixed_availability_batches', False)
+    streaming_pairs = data_config.get('streaming_pairs', False)
+    locality_group_size = data_config.get('locality_group_size', None)
+    hard_pair_mining = data_config.get('hard_pair_mining', None)
+    patch_size = data_config.get('patch_size', None)
+    patch_sampling = data_config.get('patch_sampling', 'random')
+    patch_label_ratio = data_config.get('patch_label_ratio', 0.5)
+    augmentation = data_config.get('augmentation', None)
+    fixed_validation_pairs = data_config.get('fixed_validation_pairs', None)
+    # the batches are loaded by one prefetch thread at a time, or by its load_threads, next to the cache warming threads
+    device, device_summary = setup_device(
+        getattr(config, 'backend', None),
+        loader_threads=(load_threads if load_threads > 1 else 1 if prefetch_batches > 0 else 0) + warm_threads)
+    print(device_summary)
     make_if_dont_exist(data_path)
     make_if_dont_exist(task)
     make_if_dont_exist(exp_path)
@@ -244,6 +281,8 @@ def main():
             result_seg_path = os.path.join(fold_path, 'SegNet')
             result_reg_path = os.path.join(fold_path, 'RegNet')
         
+        # one volume cache per fold, shared by the seg and reg datasets
+        volume_cache = VolumeCache(cache_bytes, compact_dtype, compression, compression_threads)
         make_if_dont_exist(fold_path)
         make_if_dont_exist(result_reg_path)
         make_if_dont_exist(result_seg_path)
@@ -263,6 +302,7 @@ def main():
             setup_logger(f'all', log_path)
             logger = logging.getLogger(f'all')
             logger.info(f"Start Pipeline with all data")
+        logger.info(device_summary)
 
         if not os.path.exists(os.path.join(fold_path, 'dataset.json')):
             logger.info('prepare dataset into train and test')
@@ -311,7 +351,7 @@ def main():
             json_dict['seg_numValid'] = len(data_seg_available_valid)
             json_dict['seg_valid'] = data_seg_available_valid
             dataset_seg_available_train, dataset_seg_available_valid = load_seg_dataset(
-                data_seg_available_train, data_seg_available_valid)
+                data_seg_available_train, data_seg_available_valid, volume_cache)
             data_item = random.choice(dataset_seg_available_train)
             img_shape = data_item['seg'].unsqueeze(0).shape[2:]
             num_label = len(torch.unique(data_item['seg']))
@@ -326,41 +366,65 @@ def main():
                 ratios=(2, 8),  # Note the order
                 shuffle=False
             )
-            data_paires_without_seg_valid = take_data_pairs(data_without_seg_valid)
-            data_pairs_valid = take_data_pairs(data_valid)
-            data_pairs_train = take_data_pairs(data_train)
-            data_pairs_valid_subdivided = subdivide_list_of_data_pairs(
-                data_pairs_valid)
-            data_pairs_train_subdivided = subdivide_list_of_data_pairs(
-                data_pairs_train)
-            num_train_reg_net = len(data_pairs_train)
-            num_valid_reg_net = len(data_pairs_valid)
-            num_train_both = len(data_pairs_train_subdivided['01']) +\
-                len(data_pairs_train_subdivided['10']) +\
-                len(data_pairs_train_subdivided['11'])
-            json_dict['reg_seg_numTrain'] = num_train_reg_net
-            json_dict['reg_seg_numTrain_00'] = len(data_pairs_train_subdivided['00'])
-            json_dict['reg_seg_train_00'] = data_pairs_train_subdivided['00']
-            json_dict['reg_seg_numTrain_01'] = len(data_pairs_train_subdivided['01'])
-            json_dict['reg_seg_train_01'] = data_pairs_train_subdivided['01']
-            json_dict['reg_seg_numTrain_10'] = len(data_pairs_train_subdivided['10'])
-            json_dict['reg_seg_train_10'] = data_pairs_train_subdivided['10']
-            json_dict['reg_seg_numTrain_11'] = len(data_pairs_train_subdivided['11'])
-            json_dict['reg_seg_train_11'] = data_pairs_train_subdivided['11']
-            json_dict['reg_numValid'] = num_valid_reg_net
-            json_dict['reg_numValid_00'] = len(data_pairs_valid_subdivided['00'])
-            json_dict['reg_valid_00'] = data_pairs_valid_subdivided['00']
-            json_dict['reg_numValid_01'] = len(data_pairs_valid_subdivided['01'])
-            json_dict['reg_valid_01'] = data_pairs_valid_subdivided['01']
-            json_dict['reg_numValid_10'] = len(data_pairs_valid_subdivided['10'])
-            json_dict['reg_valid_10'] = data_pairs_valid_subdivided['10']
-            json_dict['reg_numValid_11'] = len(data_pairs_valid_subdivided['11'])
-            json_dict['reg_valid_11'] = data_pairs_valid_subdivided['11']
-            print(f"""We have {num_train_both} pairs to train reg_net and seg_net together, and an additional {num_train_reg_net - num_train_both} to train reg_net alone.""")
-            print(f"We have {num_valid_reg_net} pairs for reg_net validation.")
+            if streaming_pairs:
+                # pairs are drawn on the fly from the scan lists, only those are stored
+                data_pairs_train = StreamingDataPairs(data_train)
+                data_pairs_valid = StreamingDataPairs(data_valid)
+                num_pairs_train = {s: data_pairs_train.num_pairs(s) for s in ['00', '01', '10', '11']}
+                num_pairs_valid = {s: data_pairs_valid.num_pairs(s) for s in ['00', '01', '10', '11']}
+                num_train_reg_net = sum(num_pairs_train.values())
+                num_valid_reg_net = sum(num_pairs_valid.values())
+                num_train_both = num_train_reg_net - num_pairs_train['00']
+                json_dict['reg_seg_numTrain'] = num_train_reg_net
+                for seg_availability, num in num_pairs_train.items():
+                    json_dict[f'reg_seg_numTrain_{seg_availability}'] = num
+                json_dict['reg_train'] = data_train
+                json_dict['reg_numValid'] = num_valid_reg_net
+                for seg_availability, num in num_pairs_valid.items():
+                    json_dict[f'reg_numValid_{seg_availability}'] = num
+                json_dict['reg_valid'] = data_valid
+                print(f"""We have {num_train_both} pairs to train reg_net and seg_net together, and an additional {num_train_reg_net - num_train_both} to train reg_net alone.""")
+                print(f"We have {num_valid_reg_net} pairs for reg_net validation.")
+                dataset_pairs_train_subdivided, dataset_pairs_valid_subdivided = load_reg_dataset(
+                    data_pairs_train, data_pairs_valid, volume_cache)
+                warm_lists = [data_seg_available_train, data_seg_available_valid, data_train, data_valid]
+            else:
+                data_pairs_valid = take_data_pairs(data_valid)
+                data_pairs_train = take_data_pairs(data_train)
+                data_pairs_valid_subdivided = subdivide_list_of_data_pairs(
+                    data_pairs_valid)
+                data_pairs_train_subdivided = subdivide_list_of_data_pairs(
+                    data_pairs_train)
+                num_train_reg_net = len(data_pairs_train)
+                num_valid_reg_net = len(data_pairs_valid)
+                num_train_both = len(data_pairs_train_subdivided['01']) +\
+                    len(data_pairs_train_subdivided['10']) +\
+                    len(data_pairs_train_subdivided['11'])
+                json_dict['reg_seg_numTrain'] = num_train_reg_net
+                json_dict['reg_seg_numTrain_00'] = len(data_pairs_train_subdivided['00'])
+                json_dict['reg_seg_train_00'] = data_pairs_train_subdivided['00']
+                json_dict['reg_seg_numTrain_01'] = len(data_pairs_train_subdivided['01'])
+                json_dict['reg_seg_train_01'] = data_pairs_train_subdivided['01']
+                json_dict['reg_seg_numTrain_10'] = len(data_pairs_train_subdivided['10'])
+                json_dict['reg_seg_train_10'] = data_pairs_train_subdivided['10']
+                json_dict['reg_seg_numTrain_11'] = len(data_pairs_train_subdivided['11'])
+                json_dict['reg_seg_train_11'] = data_pairs_train_subdivided['11']
+                json_dict['reg_numValid'] = num_valid_reg_net
+                json_dict['reg_numValid_00'] = len(data_pairs_valid_subdivided['00'])
+                json_dict['reg_valid_00'] = data_pairs_valid_subdivided['00']
+                json_dict['reg_numValid_01'] = len(data_pairs_valid_subdivided['01'])
+                json_dict['reg_valid_01'] = data_pairs_valid_subdivided['01']
+                json_dict['reg_numValid_10'] = len(data_pairs_valid_subdivided['10'])
+                json_dict['reg_valid_10'] = data_pairs_valid_subdivided['10']
+                json_dict['reg_numValid_11'] = len(data_pairs_valid_subdivided['11'])
+                json_dict['reg_valid_11'] = data_pairs_valid_subdivided['11']
+                print(f"""We have {num_train_both} pairs to train reg_net and seg_net together, and an additional {num_train_reg_net - num_train_both} to train reg_net alone.""")
+                print(f"We have {num_valid_reg_net} pairs for reg_net validation.")
 
-            dataset_pairs_train_subdivided, dataset_pairs_valid_subdivided = load_reg_dataset(
-                data_pairs_train_subdivided, data_pairs_valid_subdivided)
+                dataset_pairs_train_subdivided, dataset_pairs_valid_subdivided = load_reg_dataset(
+                    data_pairs_train_subdivided, data_pairs_valid_subdivided, volume_cache)
+                warm_lists = [data_seg_available_train, data_seg_available_valid] + \
+                    list(data_pairs_train_subdivided.values()) + list(data_pairs_valid_subdivided.values())
             logger.info('prepare registration network')
             reg_net = get_reg_net(spatial_dim, spatial_dim, dropout,
                                 activation_type, normalization_type, num_res)
@@ -373,77 +437,98 @@ def main():
             
             data_seg_available_train = dataset_json['seg_train']
             data_seg_available_valid = dataset_json['seg_valid']
-            dataset_seg_available_train, dataset_seg_available_valid = load_seg_dataset(data_seg_available_train, data_seg_available_valid)
+            dataset_seg_available_train, dataset_seg_available_valid = load_seg_dataset(data_seg_available_train, data_seg_available_valid, volume_cache)
             data_item = random.choice(dataset_seg_available_train)
             img_shape = data_item['seg'].unsqueeze(0).shape[2:]
             num_label = len(torch.unique(data_item['seg']))
             logger.info('prepare segmentation network')
             seg_net = get_seg_net(spatial_dim, num_label, dropout, activation_type, normalization_type, num_res)
             
-            data_pairs_train_subdivided = {
-                '00': dataset_json['reg_seg_train_00'],
-                '01': dataset_json['reg_seg_train_01'],
-                '10': dataset_json['reg_seg_train_10'],
-                '11': dataset_json['reg_seg_train_11']
-            }
-            data_pairs_valid_subdivided = {
-                '00': dataset_json['reg_valid_00'],
-                '01': dataset_json['reg_valid_01'],
-                '10': dataset_json['reg_valid_10'],
-                '11': dataset_json['reg_valid_11']
-            }
-            num_train_reg_net = dataset_json['reg_seg_numTrain']
-            num_valid_reg_net = dataset_json['reg_numValid']
-            num_train_both = len(data_pairs_train_subdivided['01']) +\
-                len(data_pairs_train_subdivided['10']) +\
-                len(data_pairs_train_subdivided['11'])
-            print(f"""We have {num_train_both} pairs to train reg_net and seg_net together,
-            and an additional {num_train_reg_net - num_train_both} to train reg_net alone.""")
-            print(f"We have {num_valid_reg_net} pairs for reg_net validation.")
+            if 'reg_train' in dataset_json:
+                # the fold was prepared with streaming pairs, only the scan lists are stored
+                data_train = dataset_json['reg_train']
+                data_valid = dataset_json['reg_valid']
+                num_train_reg_net = dataset_json['reg_seg_numTrain']
+                num_valid_reg_net = dataset_json['reg_numValid']
+                num_train_both = num_train_reg_net - dataset_json['reg_seg_numTrain_00']
+                print(f"""We have {num_train_both} pairs to train reg_net and seg_net together,
+                and an additional {num_train_reg_net - num_train_both} to train reg_net alone.""")
+                print(f"We have {num_valid_reg_net} pairs for reg_net validation.")
+                dataset_pairs_train_subdivided, dataset_pairs_valid_subdivided = load_reg_dataset(
+                    StreamingDataPairs(data_train), StreamingDataPairs(data_valid), volume_cache)
+                warm_lists = [data_seg_available_train, data_seg_available_valid, data_train, data_valid]
+            else:
+                data_pairs_train_subdivided = {
+                    '00': dataset_json['reg_seg_train_00'],
+                    '01': dataset_json['reg_seg_train_01'],
+                    '10': dataset_json['reg_seg_train_10'],
+                    '11': dataset_json['reg_seg_train_11']
+                }
+                data_pairs_valid_subdivided = {
+                    '00': dataset_json['reg_valid_00'],
+                    '01': dataset_json['reg_valid_01'],
+                    '10': dataset_json['reg_valid_10'],
+                    '11': dataset_json['reg_valid_11']
+                }
+                num_train_reg_net = dataset_json['reg_seg_numTrain']
+                num_valid_reg_net = dataset_json['reg_numValid']
+                num_train_both = len(data_pairs_train_subdivided['01']) +\
+                    len(data_pairs_train_subdivided['10']) +\
+                    len(data_pairs_train_subdivided['11'])
+                print(f"""We have {num_train_both} pairs to train reg_net and seg_net together,
+                and an additional {num_train_reg_net - num_train_both} to train reg_net alone.""")
+                print(f"We have {num_valid_reg_net} pairs for reg_net validation.")
 
-            dataset_pairs_train_subdivided, dataset_pairs_valid_subdivided = load_reg_dataset(
-                data_pairs_train_subdivided, data_pairs_valid_subdivided)
+                dataset_pairs_train_subdivided, dataset_pairs_valid_subdivided = load_reg_dataset(
+                    data_pairs_train_subdivided, data_pairs_valid_subdivided, volume_cache)
+                warm_lists = [data_seg_available_train, data_seg_available_valid] + \
+                    list(data_pairs_train_subdivided.values()) + list(data_pairs_valid_subdivided.values())
             logger.info('prepare registration network')
             reg_net = get_reg_net(spatial_dim, spatial_dim, dropout,
                                 activation_type, normalization_type, num_res)
 
+        if auto_batch_size is not None:
+            # probe once, on the first fold, and keep the sizes in the run config for the next runs
+            batch_sizes = find_batch_sizes(seg_net, reg_net, num_label,
+                                           patch_size if patch_size is not None else img_shape,
+                                           device, logger, mixed_precision=mixed_precision,
+                                           activation_checkpointing=activation_checkpointing,
+                                           mixed_availability_batches=mixed_availability_batches, **auto_batch_size)
+            batch_size_train_reg = batch_sizes['batch_size_train_reg']
+            batch_size_valid_reg = batch_sizes['batch_size_valid_reg']
+            batch_size_train_seg = batch_sizes['batch_size_train_seg']
+            batch_size_valid_seg = batch_sizes['batch_size_valid_seg']
+            run_config = load_json(args.config)
+            run_config['data'] = {**run_config.get('data', {}), **batch_sizes, 'auto_batch_size': None}
+            with open(args.config, 'w') as f:
+                json.dump(run_config, f, indent=4, sort_keys=False)
+            logger.info(f'write batch sizes {batch_sizes} to {args.config}')
+            auto_batch_size = None
+
+        if warm_threads > 0:
+            # fill the cache in the background, the first steps load their misses on demand
+            volume_cache.warm(warm_lists, num_threads=warm_threads, logger=logger)
         
-        dataloader_train_seg = monai.data.DataLoader(
+        # volumes are served from the in-process volume cache, so batches are assembled
+        # in a background thread, by a pool of load_threads, instead of in worker processes with private caches
+        dataloader_train_seg = batch_loader(
             dataset_seg_available_train,
-            batch_size=2,
-            num_workers=4,
-            shuffle=True
+            torch.utils.data.BatchSampler(
+                torch.utils.data.RandomSampler(dataset_seg_available_train),
+                batch_size_train_seg if batch_size_train_seg is not None else 2, drop_last=False),
+            upcast_collate,
+            load_threads
         )
-        dataloader_valid_seg = monai.data.DataLoader(
+        dataloader_valid_seg = batch_loader(
             dataset_seg_available_valid,
-            batch_size=4,
-            num_workers=4,
-            shuffle=False
+            torch.utils.data.BatchSampler(
+                torch.utils.data.SequentialSampler(dataset_seg_available_valid), batch_size_valid_seg, drop_last=False),
+            upcast_collate,
+            load_threads
         )
-        dataloader_train_reg = {
-            seg_availability: monai.data.DataLoader(
-                dataset,
-                batch_size=1,
-                num_workers=4,
-                shuffle=True
-            )
-            # empty dataloaders are not a thing-- put an empty list if needed
-            if len(dataset) > 0 else []
-            for seg_availability, dataset in dataset_pairs_train_subdivided.items()
-        }
-        dataloader_valid_reg = {
-            seg_availability: monai.data.DataLoader(
-                dataset,
-                batch_size=2,
-                num_workers=4,
-                shuffle=True  # Shuffle validation data because we will only take a sample for validation each time
-            )
-            # empty dataloaders are not a thing-- put an empty list if needed
-            if len(dataset) > 0 else []
-            for seg_availability, dataset in dataset_pairs_valid_subdivided.items()
-        }
-        train_network(dataloader_train_reg,
-                      dataloader_valid_reg,
+        # the reg buckets are sampled by a single persistent loader inside train_network
+        train_network(dataset_pairs_train_subdivided,
+                      dataset_pairs_valid_subdivided,
                       dataloader_train_seg,
                       dataloader_valid_seg,
                       device,
@@ -462,7 +547,29 @@ def main():
                       logger,
                       img_shape,
                       plot_network=args.plot_network,
-                      continue_training=continue_training
+                      continue_training=continue_training,
+                      volume_cache=volume_cache,
+                      batch_size_train_reg=batch_size_train_reg,
+                      batch_size_valid_reg=batch_size_valid_reg,
+                      prefetch_batches=prefetch_batches,
+                      load_threads=load_threads,
+                      mixed_availability_batches=mixed_availability_batches,
+                      locality_group_size=locality_group_size,
+                      hard_pair_mining=hard_pair_mining,
+                      patch_size=patch_size,
+                      patch_sampling=patch_sampling,
+                      patch_label_ratio=patch_label_ratio,
+                      augmentation=augmentation,
+                      fixed_validation_pairs=fixed_validation_pairs,
+                      mixed_precision=mixed_precision,
+                      activation_checkpointing=activation_checkpointing,
+                      batch_size_train_seg=batch_size_train_seg,
+                      batch_size_valid_seg=batch_size_valid_seg,
+                      accumulation_steps_reg=accumulation_steps_reg,
+                      accumulation_steps_seg=accumulation_steps_seg,
+                      compile_options=compile_options,
+                      compile_cache_dir=os.path.join(folder_path, 'compile_cache'),
+                      channels_last=channels_last
                       )
     '''
     seg_train.train_seg(
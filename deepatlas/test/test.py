@@ -18,6 +18,9 @@ sys.path.insert(0, os.path.join(ROOT_DIR, 'deepatlas/preprocess'))
 from process_data import (
     take_data_pairs, subdivide_list_of_data_pairs
 )
+from volume_cache import (
+    VolumeCacheDataset
+)
 from utils import (
     plot_2D_vector_field, jacobian_determinant, plot_2D_deformation, load_json
 )
@@ -25,7 +28,9 @@ from losses import (
     warp_func, warp_nearest_func, lncc_loss_func, dice_loss_func2, dice_loss_func
 )
 
-def load_seg_dataset(data_list):
+def load_seg_dataset(data_list, cache=None):
+    if cache is not None:
+        return VolumeCacheDataset(data_list, cache)
     transform_seg_available = monai.transforms.Compose(
         transforms=[
             monai.transforms.LoadImageD(keys=['img', 'seg'], image_only=True, allow_missing_keys=True),
@@ -47,7 +52,12 @@ def load_seg_dataset(data_list):
     return dataset_seg_available_train
 
 
-def load_reg_dataset(data_list):
+def load_reg_dataset(data_list, cache=None):
+    if cache is not None:
+        return {
+            seg_availability: VolumeCacheDataset(data, cache)
+            for seg_availability, data in data_list.items()
+        }
     transform_pair = monai.transforms.Compose(
         transforms=[
             monai.transforms.LoadImageD(
@@ -157,7 +167,7 @@ def get_nii_info(data, reg=False):
     return headers, affines, ids
 
 
-def seg_training_inference(seg_net, device, model_path, output_path, num_label, json_path=None, data=None):
+def seg_training_inference(seg_net, device, model_path, output_path, num_label, json_path=None, data=None, cache=None):
     if json_path is not None:
         assert data is None
         json_file = load_json(json_path)
@@ -170,7 +180,7 @@ def seg_training_inference(seg_net, device, model_path, output_path, num_label,
     seg_net.load_state_dict(torch.load(model_path, map_location=device))
     seg_net.eval()
     dice_metric = monai.metrics.DiceMetric(include_background=False, reduction='none')
-    data_seg = load_seg_dataset(raw_data)
+    data_seg = load_seg_dataset(raw_data, cache)
     k = 0
     eval_losses = []
     eval_los = []
@@ -220,7 +230,7 @@ def seg_training_inference(seg_net, device, model_path, output_path, num_label,
     torch.cuda.empty_cache()
 
 
-def reg_training_inference(reg_net, device, model_path, output_path, num_label, json_path=None, data=None):
+def reg_training_inference(reg_net, device, model_path, output_path, num_label, json_path=None, data=None, cache=None):
     if json_path is not None:
         assert data is None
         json_file = load_json(json_path)
@@ -235,7 +245,7 @@ def reg_training_inference(reg_net, device, model_path, output_path, num_label,
     data_list = take_data_pairs(raw_data)
     headers, affines, ids = get_nii_info(data_list, reg=True)
     subvided_data_list = subdivide_list_of_data_pairs(data_list)
-    subvided_dataset = load_reg_dataset(subvided_data_list)
+    subvided_dataset = load_reg_dataset(subvided_data_list, cache)
     warp = warp_func()
     warp_nearest = warp_nearest_func()
     lncc_loss = lncc_loss_func()
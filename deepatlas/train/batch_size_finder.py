@@ -0,0 +1,199 @@
+import copy
+import time
+import torch
+import os
+import sys
+from pathlib import Path
+
+ROOT_DIR = str(Path(os.getcwd()).parent.parent.absolute())
+sys.path.insert(0, os.path.join(ROOT_DIR, 'deepatlas/loss_function'))
+sys.path.insert(0, os.path.join(ROOT_DIR, 'deepatlas/network'))
+from losses import (
+    RegistrationLossEngine, seg_losses, masked_seg_losses, dice_loss_func2
+)
+from network import checkpoint_unet
+from train import mixed_precision_dtype, swap_training, reset_peak_rss, peak_rss
+
+
+def is_out_of_memory(error):
+    return isinstance(error, RuntimeError) and 'out of memory' in str(error)
+
+
+def synthetic_pair_batch(batch_size, shape, num_segmentation_classes, device, with_segs, masked=False):
+    """
+    A batch of random image pairs of the given spatial shape, with label maps if with_segs is set.
+    If masked is set, the batch is laid out as by masked_label_collate: without with_segs, the label maps
+    are all-background placeholders, and the 'seg1_mask'/'seg2_mask' of the pairs are not set.
+    """
+    batch = {'img12': torch.rand((batch_size, 2) + tuple(shape), device=device)}
+    for key in ('seg1', 'seg2'):
+        if with_segs:
+            batch[key] = torch.randint(
+                num_segmentation_classes, (batch_size, 1) + tuple(shape), device=device).float()
+        elif masked:
+            batch[key] = torch.zeros((batch_size, 1) + tuple(shape), device=device)
+        if masked:
+            batch[key + '_mask'] = torch.full((batch_size,), with_segs, dtype=torch.bool, device=device)
+    return batch
+
+
+def time_step(step, num_steps, device):
+    """
+    Seconds per call of step, after a warm up call, and the peak memory in bytes: the cuda memory allocated
+    by the steps on cuda, the peak resident set size of the process elsewhere.
+    """
+    cuda = torch.device(device).type == 'cuda'
+    if not cuda:
+        reset_peak_rss()
+    step()
+    if cuda:
+        torch.cuda.synchronize(device)
+        torch.cuda.reset_peak_memory_stats(device)
+    start = time.perf_counter()
+    for _ in range(num_steps):
+        step()
+    if cuda:
+        torch.cuda.synchronize(device)
+    seconds = (time.perf_counter() - start) / num_steps
+    return seconds, torch.cuda.max_memory_allocated(device) if cuda else peak_rss()
+
+
+def probe_batch_size(make_step, device, memory_limit, max_batch_size, min_throughput_gain, num_steps, logger, name):
+    """
+    Try batch sizes 1, 2, 4, ... up to max_batch_size with the steps built by make_step(batch_size).
+    Stops at the first batch size that runs out of memory, exceeds memory_limit bytes, or does not raise
+    the throughput (pairs per second) by at least min_throughput_gain over the previous one,
+    and returns the last batch size before that.
+
+    On cpu, running out of memory gets the process killed instead of raising, so the next batch size is not
+    tried if doubling the memory the steps used above the resident memory before probing would exceed memory_limit.
+    """
+    baseline = None
+    if torch.device(device).type != 'cuda':
+        import psutil
+        baseline = psutil.Process().memory_info().rss
+    chosen, best_throughput = 1, 0.
+    batch_size = 1
+    while batch_size <= max_batch_size:
+        try:
+            seconds, peak = time_step(make_step(batch_size), num_steps, device)
+        except RuntimeError as e:
+            if not is_out_of_memory(e):
+                raise
+            logger.info(f"\t{name} batch size {batch_size}: out of memory")
+            break
+        finally:
+            if torch.device(device).type == 'cuda':
+                torch.cuda.empty_cache()
+        throughput = batch_size / seconds
+        logger.info(f"\t{name} batch size {batch_size}: {throughput:.2f} pairs/s, peak memory {peak / 1024 ** 2:.0f} MiB")
+        if peak > memory_limit:
+            logger.info(f"\t{name} batch size {batch_size}: exceeds the memory limit")
+            break
+        if batch_size > 1 and throughput < best_throughput * (1 + min_throughput_gain):
+            break
+        chosen, best_throughput = batch_size, throughput
+        batch_size *= 2
+        if baseline is not None and batch_size <= max_batch_size and 2 * peak - baseline > memory_limit:
+            logger.info(f"\t{name} batch size {batch_size}: would exceed the memory limit")
+            break
+    logger.info(f"\t{name}: batch size {chosen}")
+    return chosen
+
+
+def find_batch_sizes(seg_net, reg_net, num_segmentation_classes, shape, device, logger,
+                     memory_fraction=0.9, max_batch_size=32, min_throughput_gain=0.05, num_steps=3,
+                     mixed_precision=None, activation_checkpointing=None, mixed_availability_batches=False):
+    """
+    Probe the largest useful batch size of each network and phase on synthetic volumes of the given shape.
+
+    Training steps are run on copies of the networks with the losses of train_network, validation steps
+    without gradients; with mixed_availability_batches set, the batches and losses are the masked ones.
+    A batch size is accepted while its peak memory stays below memory_fraction of the device memory on cuda,
+    or elsewhere of the memory available to the process (its resident memory plus the available system memory,
+    from psutil), and it raises the throughput by at least min_throughput_gain.
+
+    Returns a dict with batch_size_train_reg, batch_size_valid_reg, batch_size_train_seg and batch_size_valid_seg.
+    """
+    device_type = torch.device(device).type
+    if device_type == 'cuda':
+        memory_limit = memory_fraction * torch.cuda.get_device_properties(device).total_memory
+    else:
+        import psutil
+        memory_limit = memory_fraction * (psutil.Process().memory_info().rss + psutil.virtual_memory().available)
+    amp_dtype, _ = mixed_precision_dtype(mixed_precision, device_type, logger)
+    seg_net = copy.deepcopy(seg_net).to(device)
+    reg_net = copy.deepcopy(reg_net).to(device)
+    if activation_checkpointing is not None:
+        checkpoint_unet(seg_net, **activation_checkpointing)
+        checkpoint_unet(reg_net, **activation_checkpointing)
+    optimizer_reg = torch.optim.Adam(reg_net.parameters())
+    optimizer_seg = torch.optim.Adam(seg_net.parameters())
+    dice_loss2 = dice_loss_func2()
+    reg_losses_func = RegistrationLossEngine(num_segmentation_classes, masked=mixed_availability_batches)
+    seg_losses_func = masked_seg_losses if mixed_availability_batches else seg_losses
+
+    def autocast():
+        return torch.autocast(device_type, dtype=amp_dtype, enabled=amp_dtype is not None)
+
+    def train_reg_step(batch_size):
+        # pairs without ground truth are the most expensive, seg_net has to segment both images
+        batch = synthetic_pair_batch(batch_size, shape, num_segmentation_classes, device, with_segs=False,
+                                     masked=mixed_availability_batches)
+
+        def step():
+            optimizer_reg.zero_grad()
+            with autocast():
+                loss_sim, loss_reg, loss_ana, _ = reg_losses_func(batch, device, reg_net, seg_net,
+                                                                  num_segmentation_classes)
+                loss = loss_sim + loss_reg + loss_ana
+            loss.backward()
+            optimizer_reg.step()
+        return step
+
+    def valid_reg_step(batch_size):
+        batch = synthetic_pair_batch(batch_size, shape, num_segmentation_classes, device, with_segs=False,
+                                     masked=mixed_availability_batches)
+
+        def step():
+            with torch.no_grad(), autocast():
+                reg_losses_func(batch, device, reg_net, seg_net, num_segmentation_classes)
+        return step
+
+    def train_seg_step(batch_size):
+        batch = synthetic_pair_batch(batch_size, shape, num_segmentation_classes, device, with_segs=True,
+                                     masked=mixed_availability_batches)
+
+        def step():
+            optimizer_seg.zero_grad()
+            with autocast():
+                loss_supervised, loss_anatomy, _ = seg_losses_func(batch, device, reg_net, seg_net,
+                                                                   num_segmentation_classes)
+                loss = loss_supervised + loss_anatomy
+            loss.backward()
+            optimizer_seg.step()
+        return step
+
+    def valid_seg_step(batch_size):
+        batch = synthetic_pair_batch(batch_size, shape, num_segmentation_classes, device, with_segs=True)
+
+        def step():
+            with torch.no_grad(), autocast():
+                dice_loss2(seg_net(batch['img12'][:, [0]]).float(), batch['seg1'])
+        return step
+
+    probe = dict(device=device, memory_limit=memory_limit, max_batch_size=max_batch_size,
+                 min_throughput_gain=min_throughput_gain, num_steps=num_steps, logger=logger)
+    logger.info(f'probe batch sizes on synthetic volumes of shape {tuple(shape)}')
+    swap_training(reg_net, seg_net)
+    batch_sizes = {
+        'batch_size_train_reg': probe_batch_size(train_reg_step, name='reg training', **probe),
+        'batch_size_valid_reg': probe_batch_size(valid_reg_step, name='reg validation', **probe),
+    }
+    swap_training(seg_net, reg_net)
+    batch_sizes['batch_size_train_seg'] = probe_batch_size(train_seg_step, name='seg training', **probe)
+    batch_sizes['batch_size_valid_seg'] = probe_batch_size(valid_seg_step, name='seg validation', **probe)
+    del seg_net, reg_net, optimizer_reg, optimizer_seg
+    if device_type == 'cuda':
+        torch.cuda.empty_cache()
+    return batch_sizes
@@ -0,0 +1,171 @@
+import torch
+import numpy as np
+
+
+SPATIAL_KEYS = ['img12', 'seg1', 'seg2']
+
+
+class PatchSampler:
+    """
+    Crops every pair of a collated batch to a patch of patch_size voxels, on whatever device the batch is on.
+
+    The same window is cut from img12, seg1 and seg2 of a pair, so both images and their labels stay aligned;
+    since reg_net then predicts the displacement field on the patch grid, the field matches the patch as well.
+    Each pair of the batch gets its own window.
+
+    mode 'random' places the windows uniformly. mode 'label' centers a window, with probability label_ratio,
+    on a random foreground voxel of the ground truth of the pair (seg1 if available, else seg2), and places
+    it uniformly otherwise or if the pair has no ground truth.
+    """
+
+    def __init__(self, patch_size, mode='random', label_ratio=0.5, seed=None):
+        if mode not in ('random', 'label'):
+            raise ValueError(f"unknown patch sampling mode {mode}, expected 'random' or 'label'")
+        self.patch_size = tuple(patch_size)
+        self.mode = mode
+        self.label_ratio = label_ratio
+        self.rng = np.random.default_rng(seed)
+
+    def foreground_center(self, batch, i):
+        for key in ('seg1', 'seg2'):
+            if key not in batch or (key + '_mask' in batch and not batch[key + '_mask'][i]):
+                continue
+            foreground = torch.nonzero(batch[key][i, 0] > 0)
+            if len(foreground) > 0:
+                return foreground[self.rng.integers(len(foreground))].cpu().numpy()
+        return None
+
+    def window_start(self, batch, i, shape):
+        patch_size = np.minimum(self.patch_size, shape)
+        high = np.array(shape) - patch_size
+        center = None
+        if self.mode == 'label' and self.rng.random() < self.label_ratio:
+            center = self.foreground_center(batch, i)
+        if center is None:
+            return np.array([self.rng.integers(h + 1) for h in high]), patch_size
+        return np.clip(center - patch_size // 2, 0, high), patch_size
+
+    def __call__(self, batch):
+        shape = batch['img12'].shape[2:]
+        windows = [self.window_start(batch, i, shape) for i in range(len(batch['img12']))]
+        patched = dict(batch)
+        for key in SPATIAL_KEYS:
+            if key not in batch:
+                continue
+            patched[key] = torch.stack([
+                batch[key][i, :, start[0]:start[0] + size[0], start[1]:start[1] + size[1], start[2]:start[2] + size[2]]
+                for i, (start, size) in enumerate(windows)
+            ])
+        return patched
+
+
+def rotation_matrices(angles):
+    """ Rotation matrices, shape (B,3,3), for the rotation angles about the three axes, shape (B,3). """
+    cos, sin = np.cos(angles), np.sin(angles)
+    ones, zeros = np.ones(len(angles)), np.zeros(len(angles))
+    rx = np.stack([ones, zeros, zeros, zeros, cos[:, 0], -sin[:, 0], zeros, sin[:, 0], cos[:, 0]], axis=1)
+    ry = np.stack([cos[:, 1], zeros, sin[:, 1], zeros, ones, zeros, -sin[:, 1], zeros, cos[:, 1]], axis=1)
+    rz = np.stack([cos[:, 2], -sin[:, 2], zeros, sin[:, 2], cos[:, 2], zeros, zeros, zeros, ones], axis=1)
+    return rz.reshape(-1, 3, 3) @ ry.reshape(-1, 3, 3) @ rx.reshape(-1, 3, 3)
+
+
+class BatchAugmentation:
+    """
+    Random augmentation of a whole collated batch at once, with torch ops on the device the batch is on.
+
+    Each pair of the batch gets its own random affine transform (rotation, scaling, translation and flips),
+    applied with probability prob and folded into a single affine grid, so that the whole batch is resampled
+    by one grid_sample call for the images (trilinear) and one for the labels (nearest). img12, seg1 and seg2
+    of a pair share the transform, so labels stay on their images and the two images of a pair keep their
+    relative alignment. The images then get a random intensity scale and shift, independently per image.
+
+    rotate_range is in radians, scale_range is relative, translate_range is a fraction of the volume size.
+    Rotations and scalings are drawn in voxel space, in units of spacing (the voxel size along the three
+    volume axes, isotropic by default), so that a rotation stays rigid on a non-cubic volume.
+
+    flip_prob is the probability of a flip along each volume axis, either one for all three axes or one per axis;
+    flips are off by default. A flip mirrors the anatomy but keeps the label ids, so with lateralized labels,
+    such as separate left and right structures, a left/right flip swaps them and corrupts the ground truth;
+    only flip axes along which the labels are symmetric.
+    """
+
+    def __init__(self, prob=0.5, rotate_range=0.1, scale_range=0.1, translate_range=0.05, flip_prob=0.,
+                 intensity_scale=0.1, intensity_shift=0.1, spacing=(1., 1., 1.), seed=None):
+        self.prob = prob
+        self.rotate_range = rotate_range
+        self.scale_range = scale_range
+        self.translate_range = translate_range
+        self.flip_prob = np.broadcast_to(np.asarray(flip_prob, dtype=float), (3,))
+        self.intensity_scale = intensity_scale
+        self.intensity_shift = intensity_shift
+        self.spacing = np.asarray(spacing, dtype=float)
+        self.rng = np.random.default_rng(seed)
+
+    def affine(self, shape):
+        """
+        Random affine matrices for a batch of volumes of the given shape, (B,C,H,W,D), in the normalized
+        coordinates of affine_grid, shape (B,3,4), and which of them are not the identity.
+        """
+        rng = self.rng
+        batch_size = shape[0]
+        active = rng.random(batch_size) < self.prob
+        linear = rotation_matrices(rng.uniform(-self.rotate_range, self.rotate_range, (batch_size, 3)))
+        scales = 1 + rng.uniform(-self.scale_range, self.scale_range, (batch_size, 3))
+        # flip_prob is per volume axis, the columns of linear are in x, y, z order
+        flips = np.where(rng.random((batch_size, 3)) < self.flip_prob[::-1], -1, 1)
+        linear = linear * (scales * flips)[:, None, :]
+        # the normalized coordinates span 2 across each axis, in x, y, z order, the reverse of the volume axes:
+        # from voxel space in physical units, a transform A becomes extent^-1 A extent
+        extent = ((np.array(shape[2:]) - 1) / 2 * self.spacing)[::-1]
+        linear = linear * extent[None, None, :] / extent[None, :, None]
+        translation = 2 * rng.uniform(-self.translate_range, self.translate_range, (batch_size, 3, 1))
+        theta = np.concatenate([linear, translation], axis=2)
+        theta[~active] = np.eye(3, 4)
+        return theta, active
+
+    def __call__(self, batch):
+        img12 = batch['img12']
+        theta, active = self.affine(img12.shape)
+        augmented = dict(batch)
+        if active.any():
+            theta = torch.as_tensor(theta, dtype=img12.dtype, device=img12.device)
+            grid = torch.nn.functional.affine_grid(theta, img12.shape, align_corners=True)
+            augmented['img12'] = torch.nn.functional.grid_sample(
+                img12, grid, mode='bilinear', padding_mode='border', align_corners=True)
+            labels = [key for key in ('seg1', 'seg2') if key in batch]
+            if labels:
+                warped = torch.nn.functional.grid_sample(
+                    torch.cat([batch[key].to(img12.dtype) for key in labels], dim=1), grid,
+                    mode='nearest', padding_mode='zeros', align_corners=True)
+                for c, key in enumerate(labels):
+                    augmented[key] = warped[:, [c]].to(batch[key].dtype)
+        shape = (len(img12), img12.shape[1]) + (1,) * (img12.dim() - 2)
+        scale = 1 + self.rng.uniform(-self.intensity_scale, self.intensity_scale, shape)
+        shift = self.rng.uniform(-self.intensity_shift, self.intensity_shift, shape)
+        augmented['img12'] = augmented['img12'] * torch.as_tensor(scale, dtype=img12.dtype, device=img12.device)\
+            + torch.as_tensor(shift, dtype=img12.dtype, device=img12.device)
+        return augmented
+
+
+class BatchCompose:
+    """ Apply several batch transforms in sequence. """
+
+    def __init__(self, transforms):
+        self.transforms = [t for t in transforms if t is not None]
+
+    def __call__(self, batch):
+        for transform in self.transforms:
+            batch = transform(batch)
+        return batch
+
+
+class ChannelsLast:
+    """
+    Convert the volumes of a batch to the channels_last_3d memory format, to match networks converted with
+    net.to(memory_format=torch.channels_last_3d), so that the convolutions don't reorder their inputs.
+    """
+
+    def __call__(self, batch):
+        return {key: value.contiguous(memory_format=torch.channels_last_3d)
+                if key in SPATIAL_KEYS and key in batch else value
+                for key, value in batch.items()}
@@ -8,38 +8,436 @@ import glob
 import os.path
 import argparse
 import sys
+import threading
+import time
+import functools
+from concurrent.futures import ThreadPoolExecutor
 
 
-def create_batch_generator(dataloader_subdivided, weights=None):
+SEG_AVAILABILITIES = ['00', '01', '10', '11']
+
+
+def locality_order(pair_scans, group_size, rng):
+    """
+    A permutation of the pairs in pair_scans, an array of shape (M, 2) of target and moving scan ids,
+    that visits them in blocks sharing a working set of at most 2 * group_size scans.
+    The scans are randomly split into groups of group_size; a block holds the pairs whose target and
+    moving scans fall into a given pair of groups. Both the blocks and the pairs within a block are shuffled.
+    """
+    if len(pair_scans) == 0:
+        return np.zeros(0, dtype=np.int64)
+    scans = np.unique(pair_scans)
+    group_of = np.zeros(scans.max() + 1, dtype=np.int64)
+    group_of[rng.permutation(scans)] = np.arange(len(scans)) // group_size
+    groups = group_of[pair_scans]
+    num_groups = groups.max() + 1
+    block_rank = rng.permutation(num_groups ** 2)[groups[:, 0] * num_groups + groups[:, 1]]
+    return np.lexsort((rng.random(len(pair_scans)), block_rank))
+
+
+class InfiniteBucketBatchSampler(torch.utils.data.Sampler):
+    """
+    Endless batch sampler over the concatenation of the seg-availability buckets.
+
+    Each batch is drawn from a single bucket, picked at random with the given weights, so that
+    all items of a batch have the same keys. Within a bucket the items are visited in a freshly
+    shuffled order on every pass, and a batch never holds more items than its bucket.
+    If mix_buckets is set, the bucket is picked for every item instead, so a batch mixes
+    segmentation availabilities and has to be collated with placeholder labels and masks.
+    If pair_scans, the (target, moving) scan ids of the pairs of each bucket, and group_size are given,
+    each pass over a bucket follows locality_order instead of a plain shuffle, so that consecutive
+    pairs share a small working set of volumes that fits in the volume cache.
+    """
+
+    def __init__(self, bucket_sizes, batch_size, weights, seed=None, mix_buckets=False,
+                 pair_scans=None, group_size=None):
+        self.bucket_sizes = list(bucket_sizes)
+        self.offsets = np.cumsum([0] + self.bucket_sizes[:-1])
+        self.batch_size = batch_size
+        self.weights = weights
+        self.seed = np.random.randint(2 ** 31) if seed is None else seed
+        self.mix_buckets = mix_buckets
+        self.pair_scans = pair_scans
+        self.group_size = group_size
+
+    def __iter__(self):
+        rng = np.random.default_rng(self.seed)
+        orders = [np.zeros(0, dtype=np.int64) for _ in self.bucket_sizes]
+        positions = [0 for _ in self.bucket_sizes]
+
+        def take(b, n):
+            if positions[b] >= len(orders[b]):
+                if self.group_size is not None:
+                    orders[b] = locality_order(self.pair_scans[b], self.group_size, rng)
+                else:
+                    orders[b] = rng.permutation(self.bucket_sizes[b])
+                positions[b] = 0
+            n = min(n, len(orders[b]) - positions[b])
+            indices = (orders[b][positions[b]:positions[b] + n] + self.offsets[b]).tolist()
+            positions[b] += n
+            return indices
+
+        while True:
+            if self.mix_buckets:
+                buckets = rng.choice(len(self.bucket_sizes), size=self.batch_size, p=self.weights)
+                yield [take(b, 1)[0] for b in buckets]
+                continue
+            b = rng.choice(len(self.bucket_sizes), p=self.weights)
+            batch_size = min(self.batch_size, self.bucket_sizes[b])
+            batch = []
+            while len(batch) < batch_size:
+                batch.extend(take(b, batch_size - len(batch)))
+            yield batch
+
+
+class StreamingPairBatchSampler(torch.utils.data.Sampler):
+    """
+    Endless batch sampler that draws data pairs of a StreamingDataPairs on the fly.
+
+    A seg availability is picked with the given weights (once per batch, or for every item if
+    mix_buckets is set), then the target and moving scans are drawn uniformly from the matching
+    index arrays, never pairing a scan with itself. Each draw takes O(1) memory.
+    If group_size is given, the scans of a seg availability are drawn from a random working set of
+    group_size target and group_size moving scans, which is renewed once as many pairs as it holds
+    have been drawn, so that consecutive pairs mostly hit the volume cache.
+    """
+
+    def __init__(self, data_pairs, batch_size, weights, seed=None, mix_buckets=False, group_size=None):
+        self.index_arrays = [data_pairs.index_arrays(s) for s in SEG_AVAILABILITIES]
+        self.num_scans = len(data_pairs.data)
+        self.batch_size = batch_size
+        self.weights = weights
+        self.seed = np.random.randint(2 ** 31) if seed is None else seed
+        self.mix_buckets = mix_buckets
+        self.group_size = group_size
+
+    def draw(self, rng, first, second):
+        i = rng.integers(len(first))
+        if first is second:
+            j = rng.integers(len(second) - 1)
+            j += j >= i
+        else:
+            j = rng.integers(len(second))
+        return int(first[i]) * self.num_scans + int(second[j])
+
+    def working_set(self, rng, b):
+        """ Random subsets of the target and moving scans of seg availability b, and their number of pairs. """
+        first, second = self.index_arrays[b]
+        if first is second:
+            subset = rng.choice(first, max(2, min(self.group_size, len(first))), replace=False)
+            return subset, subset, len(subset) * (len(subset) - 1)
+        first = rng.choice(first, min(self.group_size, len(first)), replace=False)
+        second = rng.choice(second, min(self.group_size, len(second)), replace=False)
+        return first, second, len(first) * len(second)
+
+    def __iter__(self):
+        rng = np.random.default_rng(self.seed)
+        working_sets = list(self.index_arrays)
+        remaining = [0 for _ in SEG_AVAILABILITIES]
+
+        def draw(b):
+            if self.group_size is not None:
+                if remaining[b] == 0:
+                    first, second, remaining[b] = self.working_set(rng, b)
+                    working_sets[b] = (first, second)
+                remaining[b] -= 1
+            return self.draw(rng, *working_sets[b])
+
+        while True:
+            if self.mix_buckets:
+                buckets = rng.choice(len(SEG_AVAILABILITIES), size=self.batch_size, p=self.weights)
+            else:
+                buckets = [rng.choice(len(SEG_AVAILABILITIES), p=self.weights)] * self.batch_size
+            yield [draw(b) for b in buckets]
+
+
+class HardPairBatchSampler(torch.utils.data.Sampler):
+    """
+    Endless batch sampler over the concatenation of the seg-availability buckets that draws the pairs
+    with a high running loss more often.
+
+    The bucket of a batch (or of every item, if mix_buckets is set) is picked with the given weights as in
+    InfiniteBucketBatchSampler. Within the bucket, a pair is drawn with probability
+        floor / M + (1 - floor) * softmax(running_loss / temperature)
+    over the M pairs of the bucket, so that no pair is ever starved. The running loss of a pair is an
+    exponential moving average, with the given momentum, of the losses passed to update(); pairs that
+    have not been seen yet count as the highest running loss of their bucket, so they are visited early.
+    """
+
+    def __init__(self, bucket_sizes, batch_size, weights, seed=None, mix_buckets=False,
+                 temperature=1.0, floor=0.1, momentum=0.9):
+        self.bucket_sizes = list(bucket_sizes)
+        self.offsets = np.cumsum([0] + self.bucket_sizes[:-1])
+        self.batch_size = batch_size
+        self.weights = weights
+        self.seed = np.random.randint(2 ** 31) if seed is None else seed
+        self.mix_buckets = mix_buckets
+        self.temperature = temperature
+        self.floor = floor
+        self.momentum = momentum
+        self.running_losses = np.full(sum(self.bucket_sizes), np.nan)
+        # update() runs in the training loop while the loader thread draws batches
+        self.lock = threading.Lock()
+
+    def probabilities(self, b):
+        """ Sampling probabilities of the pairs of bucket b. """
+        with self.lock:
+            losses = self.running_losses[self.offsets[b]:self.offsets[b] + self.bucket_sizes[b]].copy()
+        seen = ~np.isnan(losses)
+        if not seen.any():
+            return np.full(len(losses), 1 / len(losses))
+        losses[~seen] = losses[seen].max()
+        logits = (losses - losses.max()) / self.temperature
+        hard = np.exp(logits) / np.exp(logits).sum()
+        return self.floor / len(losses) + (1 - self.floor) * hard
+
+    def take(self, rng, b, n):
+        p = self.probabilities(b)
+        n = min(n, np.count_nonzero(p))
+        indices = rng.choice(self.bucket_sizes[b], size=n, replace=False, p=p)
+        return (indices + self.offsets[b]).tolist()
+
+    def update(self, indices, losses):
+        """ Fold the losses of the pairs with the given dataset indices into their running losses. """
+        indices = np.asarray(indices, dtype=np.int64)
+        losses = np.asarray(losses, dtype=np.float64)
+        with self.lock:
+            previous = self.running_losses[indices]
+            self.running_losses[indices] = np.where(
+                np.isnan(previous), losses, self.momentum * previous + (1 - self.momentum) * losses)
+
+    def summary(self):
+        with self.lock:
+            losses = self.running_losses.copy()
+        seen = ~np.isnan(losses)
+        if not seen.any():
+            return 'no pair losses recorded'
+        return (f"{seen.sum()}/{len(losses)} pairs seen, running loss "
+                f"min {losses[seen].min():.4f}, mean {losses[seen].mean():.4f}, max {losses[seen].max():.4f}")
+
+    def __iter__(self):
+        rng = np.random.default_rng(self.seed)
+        while True:
+            if self.mix_buckets:
+                buckets = rng.choice(len(self.bucket_sizes), size=self.batch_size, p=self.weights)
+                yield [self.take(rng, b, 1)[0] for b in buckets]
+                continue
+            b = rng.choice(len(self.bucket_sizes), p=self.weights)
+            yield self.take(rng, b, self.batch_size)
+
+
+class IndexedDataset(torch.utils.data.Dataset):
+    """ Adds the index of each item, as 'pair_index', to the dictionaries of a dataset. """
+
+    def __init__(self, dataset):
+        self.dataset = dataset
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __getitem__(self, index):
+        return {**self.dataset[index], 'pair_index': index}
+
+
+class BatchLoadingDataset(torch.utils.data.Dataset):
+    """
+    Dataset indexed by the list of indices of a whole batch, as drawn by a batch sampler, whose items are
+    loaded concurrently by a pool of num_threads threads, so that the volume cache misses of a batch are
+    read in parallel. Serve it with the batch sampler as sampler and batch_size=None, see batch_loader.
+
+    Thread workers of the loader (use_thread_workers) would load batches in parallel as well, but torch's
+    worker loop sets the intra-op threads to 1 and reseeds torch, for the whole process when it runs in a thread.
+    """
+
+    def __init__(self, dataset, num_threads):
+        self.dataset = dataset
+        self.pool = ThreadPoolExecutor(num_threads, thread_name_prefix='batch_loading')
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __getitem__(self, indices):
+        return list(self.pool.map(self.dataset.__getitem__, indices))
+
+
+def batch_loader(dataset, batch_sampler, collate_fn, load_threads=1, prefetch=1, **kwargs):
+    """
+    A ThreadDataLoader drawing the batches of batch_sampler from dataset in its background thread, which stages
+    up to prefetch batches ahead. With prefetch 0 there is no background thread, and the batches are loaded
+    when they are drawn (a ThreadDataLoader with buffer_size 0 would stage an unbounded number of batches).
+    If load_threads > 1, the items of each batch are loaded concurrently, see BatchLoadingDataset.
+    The remaining keyword arguments go to the loader.
+    """
+    if prefetch > 0:
+        loader = functools.partial(monai.data.ThreadDataLoader, buffer_size=prefetch)
+    else:
+        loader = monai.data.DataLoader
+    if load_threads > 1:
+        return loader(BatchLoadingDataset(dataset, load_threads), sampler=batch_sampler,
+                      batch_size=None, num_workers=0, collate_fn=collate_fn, **kwargs)
+    return loader(dataset, batch_sampler=batch_sampler, num_workers=0, collate_fn=collate_fn, **kwargs)
+
+
+def count_pairs(dataset_subdivided):
+    """
+    Number of data pairs of each seg availability, for a mapping from the labels in seg_availabilities
+    to datasets as well as for a single dataset over StreamingDataPairs.
+    """
+    if isinstance(dataset_subdivided, dict):
+        return {s: len(dataset_subdivided[s]) for s in SEG_AVAILABILITIES}
+    return {s: dataset_subdivided.data.num_pairs(s) for s in SEG_AVAILABILITIES}
+
+
+def create_batch_generator(dataset_subdivided, batch_size, weights=None, collate_fn=None, seed=None,
+                           prefetch=1, device=None, mix_buckets=False, locality_group_size=None,
+                           hard_pair_mining=None, batch_transform=None, load_threads=1):
     """
     Create a batch generator that samples data pairs with various segmentation availabilities.
 
     Arguments:
-        dataloader_subdivided : a mapping from the labels in seg_availabilities to dataloaders
+        dataset_subdivided : a mapping from the labels in seg_availabilities to datasets,
+                             or a single dataset over StreamingDataPairs to draw pairs on the fly
+        batch_size : the number of data pairs in a batch
         weights : a list of probabilities, one for each label in seg_availabilities;
                   if not provided then we weight by the number of data items of each type,
                   effectively sampling uniformly over the union of the datasets
+        collate_fn : the collate function of the loader, monai's list_data_collate by default
+        seed : the seed of the sampler; if not provided it is drawn from numpy's global random state
+        prefetch : the number of batches staged ahead by the loader's background thread; 0 for no background thread
+        device : if provided, batches are moved to this device before they are yielded;
+                 for a cuda device they are staged in pinned memory and copied asynchronously
+        mix_buckets : if True, a batch mixes items of different seg_availabilities;
+                      use a collate_fn that pads the missing labels, such as masked_label_collate
+        locality_group_size : if provided, pairs are ordered in blocks that share a working set of
+                              about twice this many scans, so that most fetches hit the volume cache
+        hard_pair_mining : if provided, a dict of HardPairBatchSampler options (temperature, floor, momentum);
+                           pairs with a high running loss are then drawn more often, batches carry their
+                           'pair_index' and the losses are fed back with batch_generator.update_losses()
+        batch_transform : if provided, a callable applied to every collated batch once it is on device,
+                          such as a batch_transforms.PatchSampler
+        load_threads : the number of threads loading the pairs of a batch concurrently, see batch_loader
 
     Returns: batch_generator
-        A function that accepts a number of batches to sample and that returns a generator.
+        A callable that accepts a number of batches to sample and that returns a generator.
         The generator will weighted-randomly pick one of the seg_availabilities and
-        yield the next batch from the corresponding dataloader.
+        yield the next batch from the corresponding dataset.
+
+    All the buckets are served by a single loader over an endless sampler. Its iterator is created
+    once and kept for the whole run, so loading never restarts in the middle of an epoch;
+    call batch_generator.close() at the end of training to stop its background thread.
+    The time spent waiting on each fetch is recorded, see BatchGenerator.wait_summary().
     """
-    seg_availabilities = ['00', '01', '10', '11']
+    num_pairs = count_pairs(dataset_subdivided)
+    bucket_sizes = [num_pairs[s] for s in SEG_AVAILABILITIES]
     if weights is None:
-        weights = np.array([len(dataloader_subdivided[s]) for s in seg_availabilities])
-    weights = np.array(weights)
+        weights = bucket_sizes
+    # an empty bucket can never be sampled
+    weights = np.array(weights, dtype=np.float64) * (np.array(bucket_sizes) > 0)
     weights = weights / weights.sum()
-    dataloader_subdivided_as_iterators = {s: iter(d) for s, d in dataloader_subdivided.items()}
+    if hard_pair_mining is not None:
+        if not isinstance(dataset_subdivided, dict):
+            raise ValueError('hard pair mining keeps a running loss per pair and needs the pair lists; '
+                             'it cannot be combined with streaming pairs')
+        dataset = IndexedDataset(
+            torch.utils.data.ConcatDataset([dataset_subdivided[s] for s in SEG_AVAILABILITIES]))
+        sampler = HardPairBatchSampler(bucket_sizes, batch_size, weights, seed, mix_buckets, **hard_pair_mining)
+    elif isinstance(dataset_subdivided, dict):
+        dataset = torch.utils.data.ConcatDataset([dataset_subdivided[s] for s in SEG_AVAILABILITIES])
+        pair_scans = None
+        if locality_group_size is not None:
+            scan_ids = {}
+            pair_scans = [
+                np.array([[scan_ids.setdefault(pair['img1'], len(scan_ids)),
+                           scan_ids.setdefault(pair['img2'], len(scan_ids))]
+                          for pair in dataset_subdivided[s].data], dtype=np.int64).reshape(-1, 2)
+                for s in SEG_AVAILABILITIES
+            ]
+        sampler = InfiniteBucketBatchSampler(bucket_sizes, batch_size, weights, seed, mix_buckets,
+                                             pair_scans, locality_group_size)
+    else:
+        dataset = dataset_subdivided
+        sampler = StreamingPairBatchSampler(dataset.data, batch_size, weights, seed, mix_buckets,
+                                            locality_group_size)
+    dataloader = batch_loader(
+        dataset,
+        sampler,
+        collate_fn if collate_fn is not None else monai.data.list_data_collate,
+        load_threads,
+        prefetch,
+        pin_memory=device is not None and torch.device(device).type == 'cuda'
+    )
+    return BatchGenerator(dataloader, device, sampler, batch_transform)
+
+
+def collect_batches(dataset_subdivided, num_pairs, batch_size, weights=None, collate_fn=None, seed=0,
+                    mix_buckets=False, batch_transform=None, load_threads=1):
+    """
+    Draw a fixed list of collated batches, holding about num_pairs data pairs, once.
+    The batches stay in host memory, so they can be evaluated again and again, e.g. as a validation subset
+    that is identical from one epoch to the next. The arguments are as for create_batch_generator.
+    """
+    batch_generator = create_batch_generator(dataset_subdivided, batch_size, weights, collate_fn, seed,
+                                             mix_buckets=mix_buckets, batch_transform=batch_transform,
+                                             load_threads=load_threads)
+    batches = list(batch_generator(int(np.ceil(num_pairs / batch_size))))
+    batch_generator.close()
+    return batches
+
+
+class BatchGenerator:
+    """
+    Draws batches from a single persistent iterator over an endless dataloader,
+    moving them to device if one is given, applying batch_transform if one is given,
+    and recording how long each fetch waited.
+    """
+
+    def __init__(self, dataloader, device=None, sampler=None, batch_transform=None):
+        self.dataloader = dataloader
+        self.device = device
+        self.sampler = sampler
+        self.batch_transform = batch_transform
+        self.batches = None
+        self.wait_seconds = []
+
+    @property
+    def tracks_losses(self):
+        return isinstance(self.sampler, HardPairBatchSampler)
+
+    def update_losses(self, batch, losses):
+        """ Report the per-pair losses, shape (B,), of a batch drawn by a hard pair mining generator. """
+        self.sampler.update(batch['pair_index'].cpu().numpy(), losses.detach().float().cpu().numpy())
 
-    def batch_generator(num_batches_to_sample):
+    def sampler_summary(self):
+        return self.sampler.summary()
+
+    def __call__(self, num_batches_to_sample):
+        if self.batches is None:
+            self.batches = iter(self.dataloader)
         for _ in range(num_batches_to_sample):
-            seg_availability = np.random.choice(seg_availabilities, p=weights)
-            try:
-                yield next(dataloader_subdivided_as_iterators[seg_availability])
-            except StopIteration:  # If dataloader runs out, restart it
-                dataloader_subdivided_as_iterators[seg_availability] =\
-                    iter(dataloader_subdivided[seg_availability])
-                yield next(dataloader_subdivided_as_iterators[seg_availability])
-    return batch_generator
- 
\ No newline at end of file
+            start = time.perf_counter()
+            batch = next(self.batches)
+            self.wait_seconds.append(time.perf_counter() - start)
+            if self.device is not None:
+                batch = {key: value.to(self.device, non_blocking=True) if torch.is_tensor(value) else value
+                         for key, value in batch.items()}
+            if self.batch_transform is not None:
+                batch = self.batch_transform(batch)
+            yield batch
+
+    def wait_summary(self):
+        """Summarize the fetch waits recorded since the last reset_wait_stats()."""
+        if len(self.wait_seconds) == 0:
+            return 'no batches fetched'
+        waits = np.array(self.wait_seconds) * 1000
+        return (f"{len(waits)} batches, data wait total {waits.sum():.1f} ms, "
+                f"mean {waits.mean():.1f} ms, max {waits.max():.1f} ms")
+
+    def reset_wait_stats(self):
+        self.wait_seconds = []
+
+    def close(self):
+        """Stop the loader thread, if there is one; the next call starts a new iterator."""
+        if self.batches is not None:
+            if hasattr(self.batches, 'close'):
+                self.batches.close()
+            self.batches = None
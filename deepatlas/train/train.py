@@ -1,4 +1,5 @@
 import generators
+import batch_transforms
 import monai
 import torch
 import numpy as np
@@ -8,18 +9,26 @@ import os
 import sys
 from pathlib import Path
 import pickle
+import functools
+import resource
 
 ROOT_DIR = str(Path(os.getcwd()).parent.parent.absolute())
 sys.path.insert(0, os.path.join(ROOT_DIR, 'deepatlas/utils'))
 sys.path.insert(0, os.path.join(ROOT_DIR, 'deepatlas/loss_function'))
+sys.path.insert(0, os.path.join(ROOT_DIR, 'deepatlas/preprocess'))
+sys.path.insert(0, os.path.join(ROOT_DIR, 'deepatlas/network'))
 from utils import (
     preview_image, preview_3D_vector_field, preview_3D_deformation,
     jacobian_determinant, plot_progress, make_if_dont_exist, save_seg_checkpoint, save_reg_checkpoint, load_latest_checkpoint,
     load_best_checkpoint, load_valid_checkpoint, plot_architecture
 )
 from losses import (
-    warp_func, warp_nearest_func, lncc_loss_func, dice_loss_func, reg_losses, dice_loss_func2
+    dice_loss_func2, seg_losses, masked_seg_losses, RegistrationLossEngine
 )
+from volume_cache import (
+    upcast_collate, masked_label_collate
+)
+from network import checkpoint_unet
 
 
 def swap_training(network_to_train, network_to_not_train):
@@ -36,8 +45,94 @@ def swap_training(network_to_train, network_to_not_train):
     network_to_not_train.eval()
     network_to_train.train()
 
-def train_network(dataloader_train_reg,
-                  dataloader_valid_reg,
+def reset_peak_rss():
+    """ Reset the peak resident set size of the process, on Linux; elsewhere peak_rss stays the peak since start. """
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+
+
+def peak_rss():
+    """ The peak resident set size of the process in bytes, since the last reset_peak_rss. """
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    # ru_maxrss is in KiB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def reset_peak_memory(device_type):
+    """ Reset the peak cuda memory allocated, or the peak resident set size on cpu. """
+    if device_type == 'cuda':
+        torch.cuda.reset_peak_memory_stats()
+    else:
+        reset_peak_rss()
+
+
+def peak_memory_summary(device_type):
+    """
+    Peak cuda memory allocated since the last reset, or on cpu the peak resident set size of the process,
+    which also counts the volume cache and the loader buffers; then reset the peak.
+    """
+    if device_type == 'cuda':
+        summary = f"{torch.cuda.max_memory_allocated() / 1024 ** 2:.0f} MiB allocated"
+    else:
+        summary = f"{peak_rss() / 1024 ** 2:.0f} MiB resident"
+    reset_peak_memory(device_type)
+    return summary
+
+
+def mixed_precision_dtype(mixed_precision, device_type, logger):
+    """
+    The autocast dtype for the mixed_precision setting, None, 'bf16' or 'fp16', on a device type,
+    and whether the gradients need to be scaled. fp16 autocast needs cuda; elsewhere bf16 is used instead.
+    """
+    if mixed_precision is None:
+        return None, False
+    if mixed_precision not in ('bf16', 'fp16'):
+        raise ValueError(f"unknown mixed precision mode {mixed_precision}, expected 'bf16' or 'fp16'")
+    if mixed_precision == 'fp16' and device_type != 'cuda':
+        logger.info(f'fp16 autocast is not available on {device_type}, using bf16')
+        mixed_precision = 'bf16'
+    if mixed_precision == 'fp16':
+        # fp16 gradients underflow without loss scaling
+        return torch.float16, True
+    return torch.bfloat16, False
+
+
+def compile_networks(seg_net, reg_net, compile_options, cache_dir, logger, loss_engine=None):
+    """
+    Compile the forward passes of seg_net and reg_net with torch.compile, and the registration losses of
+    loss_engine (a RegistrationLossEngine), if one is given.
+    Only the forward methods are replaced, so the state_dict keys are unchanged. Compiled kernels are
+    cached in cache_dir, so that resumed runs and later folds reuse them; a graph that fails to compile
+    runs eagerly instead.
+    """
+    if not hasattr(torch, 'compile'):
+        logger.info(f'torch.compile is not available in torch {torch.__version__}, running eagerly')
+        return
+    from torch._dynamo import config as dynamo_config
+    from torch._inductor import config as inductor_config
+    os.environ['TORCHINDUCTOR_CACHE_DIR'] = cache_dir
+    inductor_config.fx_graph_cache = True
+    dynamo_config.suppress_errors = True
+    compile_func = functools.partial(torch.compile, **compile_options)
+    seg_net.forward = compile_func(seg_net.forward)
+    reg_net.forward = compile_func(reg_net.forward)
+    if loss_engine is not None:
+        loss_engine.compile(compile_func)
+    logger.info(f'compiled seg_net, reg_net{" and the registration losses" if loss_engine is not None else ""}, '
+                f'cache in {cache_dir}')
+
+
+def train_network(dataset_train_reg,
+                  dataset_valid_reg,
                   dataloader_train_seg,
                   dataloader_valid_seg,
                   device,
@@ -56,7 +151,29 @@ def train_network(dataloader_train_reg,
                   logger,
                   img_shape,
                   plot_network=False,
-                  continue_training=False
+                  continue_training=False,
+                  volume_cache=None,
+                  batch_size_train_reg=1,
+                  batch_size_valid_reg=2,
+                  prefetch_batches=2,
+                  load_threads=1,
+                  mixed_availability_batches=False,
+                  locality_group_size=None,
+                  hard_pair_mining=None,
+                  patch_size=None,
+                  patch_sampling='random',
+                  patch_label_ratio=0.5,
+                  augmentation=None,
+                  fixed_validation_pairs=None,
+                  mixed_precision=None,
+                  activation_checkpointing=None,
+                  batch_size_train_seg=None,
+                  batch_size_valid_seg=4,
+                  accumulation_steps_reg=1,
+                  accumulation_steps_seg=1,
+                  compile_options=None,
+                  compile_cache_dir=None,
+                  channels_last=False
                   ):
     # Training cell
     
@@ -69,19 +186,83 @@ def train_network(dataloader_train_reg,
     
     ROOT_DIR = str(Path(result_reg_path).parent.absolute())
     seg_availabilities = ['00', '01', '10', '11']
+    num_pairs_train_reg = generators.count_pairs(dataset_train_reg)
+    num_valid_reg = sum(generators.count_pairs(dataset_valid_reg).values())
+    if mixed_availability_batches:
+        # pairs of all segmentation availabilities share a batch, missing labels are masked out
+        collate_fn = masked_label_collate
+        seg_losses_func = masked_seg_losses
+    else:
+        collate_fn = upcast_collate
+        seg_losses_func = seg_losses
+    # the reg phase losses are computed by one engine that keeps its loss modules and warp grids between steps
+    reg_losses_func = RegistrationLossEngine(num_segmentation_classes, masked=mixed_availability_batches)
+    # in patch mode both networks train on patches, so memory and step time don't depend on the volume size
+    patch_sampler = batch_transforms.PatchSampler(patch_size, patch_sampling, patch_label_ratio)\
+        if patch_size is not None else None
+    # augmentation runs on the collated training batches on device, before they are patched
+    # with channels_last, batches are converted once on device, matching the layout of the networks
+    layout_transform = batch_transforms.ChannelsLast() if channels_last else None
+    train_transform = batch_transforms.BatchCompose([
+        batch_transforms.BatchAugmentation(**augmentation) if augmentation is not None else None,
+        patch_sampler,
+        layout_transform
+    ])
+    valid_transform = batch_transforms.BatchCompose([patch_sampler, layout_transform])
     batch_generator_train_reg = generators.create_batch_generator(
-        dataloader_train_reg)
-    batch_generator_valid_reg = generators.create_batch_generator(
-        dataloader_valid_reg)
+        dataset_train_reg, batch_size_train_reg, collate_fn=collate_fn,
+        prefetch=prefetch_batches, device=device, mix_buckets=mixed_availability_batches,
+        locality_group_size=locality_group_size, hard_pair_mining=hard_pair_mining,
+        batch_transform=train_transform, load_threads=load_threads)
+    if num_valid_reg > 0 and fixed_validation_pairs is not None:
+        # the same validation pairs (and patches) are evaluated at every validation step
+        validation_batches_reg = generators.collect_batches(
+            dataset_valid_reg, fixed_validation_pairs, batch_size_valid_reg, collate_fn=collate_fn,
+            mix_buckets=mixed_availability_batches, load_threads=load_threads,
+            batch_transform=batch_transforms.BatchCompose([
+                batch_transforms.PatchSampler(patch_size, patch_sampling, patch_label_ratio, seed=0)
+                if patch_size is not None else None,
+                layout_transform
+            ]))
+        logger.info(f"reg validation uses a fixed subset of {sum(len(b['img12']) for b in validation_batches_reg)} pairs")
+    elif num_valid_reg > 0:
+        batch_generator_valid_reg = generators.create_batch_generator(
+            dataset_valid_reg, batch_size_valid_reg, collate_fn=collate_fn,
+            prefetch=prefetch_batches, device=device, mix_buckets=mixed_availability_batches,
+            locality_group_size=locality_group_size, batch_transform=valid_transform, load_threads=load_threads)
     seg_train_sampling_weights = [
-        0] + [len(dataloader_train_reg[s]) for s in seg_availabilities[1:]]
+        0] + [num_pairs_train_reg[s] for s in seg_availabilities[1:]]
     print('----------'*10)
     print(f"""When training seg_net alone, segmentation availabilities {seg_availabilities}
     will be sampled with respective weights {seg_train_sampling_weights}""")
     batch_generator_train_seg = generators.create_batch_generator(
-        dataloader_train_reg, seg_train_sampling_weights)
+        dataset_train_reg, batch_size_train_seg if batch_size_train_seg is not None else batch_size_train_reg,
+        seg_train_sampling_weights, collate_fn=collate_fn,
+        prefetch=prefetch_batches, device=device, mix_buckets=mixed_availability_batches,
+        locality_group_size=locality_group_size, batch_transform=train_transform, load_threads=load_threads)
     seg_net = seg_net.to(device)
     reg_net = reg_net.to(device)
+    if channels_last:
+        seg_net = seg_net.to(memory_format=torch.channels_last_3d)
+        reg_net = reg_net.to(memory_format=torch.channels_last_3d)
+    if activation_checkpointing is not None:
+        logger.info(f'activation checkpointing: {activation_checkpointing}')
+        checkpoint_unet(seg_net, **activation_checkpointing)
+        checkpoint_unet(reg_net, **activation_checkpointing)
+    if compile_options is not None:
+        compile_networks(seg_net, reg_net, compile_options,
+                         compile_cache_dir if compile_cache_dir is not None else os.path.join(ROOT_DIR, 'compile_cache'),
+                         logger, reg_losses_func)
+    device_type = torch.device(device).type
+    # peak memory is reported per phase, e.g. to compare runs with and without activation checkpointing
+    amp_dtype, scale_gradients = mixed_precision_dtype(mixed_precision, device_type, logger)
+
+    def autocast():
+        return torch.autocast(device_type, dtype=amp_dtype, enabled=amp_dtype is not None)
+    scaler_reg = torch.cuda.amp.GradScaler(enabled=scale_gradients)
+    scaler_seg = torch.cuda.amp.GradScaler(enabled=scale_gradients)
+    if amp_dtype is not None:
+        logger.info(f'mixed precision training with {amp_dtype} autocast, gradient scaling: {scale_gradients}')
 
     learning_rate_reg = lr_reg
     optimizer_reg = torch.optim.Adam(reg_net.parameters(), learning_rate_reg)
@@ -163,11 +344,16 @@ def train_network(dataloader_train_reg,
             elif os.path.exists(os.path.join(result_reg_path, 'checkpoints', 'latest_checkpoint.pth')):
                 os.remove(os.path.join(result_reg_path, 'checkpoints', 'latest_checkpoint.pth'))
     
-    if len(dataloader_valid_reg) == 0:
+    if num_valid_reg == 0:
         validation_losses_reg = []
     
     if len(dataloader_valid_seg) == 0:
         validation_losses_seg = []
+    elif fixed_validation_pairs is not None:
+        # keep the collated seg validation scans in memory instead of reloading them every validation step
+        validation_batches_seg = list(dataloader_valid_seg)
+    else:
+        validation_batches_seg = dataloader_valid_seg
     
     lambda_a = lam_a  # anatomy loss weight
     lambda_sp = lam_sp  # supervised segmentation loss weight
@@ -192,24 +378,40 @@ def train_network(dataloader_train_reg,
     for epoch_number in range(last_epoch, max_epochs):
 
         logger.info(f"Epoch {epoch_number+1}/{max_epochs}:")
+        if volume_cache is not None:
+            # report the cache hit rate achieved within each epoch
+            volume_cache.reset_stats()
             # ------------------------------------------------
             #         reg_net training, with seg_net frozen
             # ------------------------------------------------
 
             # Keep computational graph in memory for reg_net, but not for seg_net, and do reg_net.train()
         swap_training(reg_net, seg_net)
+        reset_peak_memory(device_type)
 
         losses = []
         regularization_loss = []
         similarity_loss = []
         anatomy_loss = []
-        for batch in batch_generator_train_reg(reg_phase_training_batches_per_epoch):
-            optimizer_reg.zero_grad()
-            loss_sim, loss_reg, loss_ana, df = reg_losses(
-                batch, device, reg_net, seg_net, num_segmentation_classes)
-            loss = loss_sim + lambda_r * loss_reg + lambda_a * loss_ana
-            loss.backward()
-            optimizer_reg.step()
+        # every optimizer step accumulates the gradients of accumulation_steps_reg micro-batches
+        for step, batch in enumerate(batch_generator_train_reg(
+                reg_phase_training_batches_per_epoch * accumulation_steps_reg)):
+            if step % accumulation_steps_reg == 0:
+                optimizer_reg.zero_grad()
+            with autocast():
+                if batch_generator_train_reg.tracks_losses:
+                    loss_sim, loss_reg, loss_ana, df = reg_losses_func(
+                        batch, device, reg_net, seg_net, num_segmentation_classes, per_sample=True)
+                    batch_generator_train_reg.update_losses(batch, loss_sim + lambda_a * loss_ana)
+                    loss_sim, loss_ana = loss_sim.mean(), loss_ana.mean()
+                else:
+                    loss_sim, loss_reg, loss_ana, df = reg_losses_func(
+                        batch, device, reg_net, seg_net, num_segmentation_classes)
+                loss = loss_sim + lambda_r * loss_reg + lambda_a * loss_ana
+            scaler_reg.scale(loss / accumulation_steps_reg).backward()
+            if (step + 1) % accumulation_steps_reg == 0:
+                scaler_reg.step(optimizer_reg)
+                scaler_reg.update()
             losses.append(loss.item())
             regularization_loss.append(loss_reg.item())
             similarity_loss.append(loss_sim.item())
@@ -223,11 +425,16 @@ def train_network(dataloader_train_reg,
         similarity_loss_reg.append([epoch_number+1, np.mean(similarity_loss)])
         anatomy_loss_reg.append([epoch_number+1, np.mean(anatomy_loss)])
         logger.info(f"\treg training loss: {training_loss_reg}")
+        logger.info(f"\treg data loading: {batch_generator_train_reg.wait_summary()}")
+        logger.info(f"\treg peak memory: {peak_memory_summary(device_type)}")
+        if batch_generator_train_reg.tracks_losses:
+            logger.info(f"\treg pair mining: {batch_generator_train_reg.sampler_summary()}")
+        batch_generator_train_reg.reset_wait_stats()
         training_losses_reg.append([epoch_number+1, training_loss_reg])
         logger.info("\tsave latest reg_net checkpoint")
         save_reg_checkpoint(reg_net, optimizer_reg, epoch_number, training_loss_reg, sim_loss=similarity_loss_reg, regular_loss=regularization_loss_reg, ana_loss=anatomy_loss_reg, total_loss=training_losses_reg, save_dir=os.path.join(result_reg_path, 'checkpoints'), name='latest')
         # validation process
-        if len(dataloader_valid_reg) == 0:
+        if num_valid_reg == 0:
             logger.info("\tno enough dataset for validation")
             save_reg_checkpoint(reg_net, optimizer_reg, epoch_number, training_loss_reg, sim_loss=similarity_loss_reg, regular_loss=regularization_loss_reg, ana_loss=anatomy_loss_reg, total_loss=training_losses_reg, save_dir=os.path.join(result_reg_path, 'checkpoints'), name='best')
             save_reg_checkpoint(reg_net, optimizer_reg, epoch_number, training_loss_reg, sim_loss=similarity_loss_reg, regular_loss=regularization_loss_reg, ana_loss=anatomy_loss_reg, total_loss=training_losses_reg, save_dir=os.path.join(result_reg_path, 'checkpoints'), name='valid')
@@ -240,9 +447,13 @@ def train_network(dataloader_train_reg,
             if epoch_number % val_interval == 0:
                 reg_net.eval()
                 losses = []
-                with torch.no_grad():
-                    for batch in batch_generator_valid_reg(reg_phase_num_validation_batches_to_use):
-                        loss_sim, loss_reg, loss_ana, dv = reg_losses(
+                with torch.no_grad(), autocast():
+                    if fixed_validation_pairs is not None:
+                        validation_batches = validation_batches_reg
+                    else:
+                        validation_batches = batch_generator_valid_reg(reg_phase_num_validation_batches_to_use)
+                    for batch in validation_batches:
+                        loss_sim, loss_reg, loss_ana, dv = reg_losses_func(
                             batch, device, reg_net, seg_net, num_segmentation_classes)
                         loss = loss_sim + lambda_r * loss_reg + lambda_a * loss_ana
                         losses.append(loss.item())
@@ -278,67 +489,24 @@ def train_network(dataloader_train_reg,
         # Keep computational graph in memory for seg_net, but not for reg_net, and do seg_net.train()
         logger.info('\t'+'----'*10)
         swap_training(seg_net, reg_net)
+        reset_peak_memory(device_type)
         losses = []
         supervised_loss = []
         anatomy_loss = []
-        dice_loss = dice_loss_func()
-        warp = warp_func()
-        warp_nearest = warp_nearest_func()
         dice_loss2 = dice_loss_func2()
-        for batch in batch_generator_train_seg(seg_phase_training_batches_per_epoch):
-            optimizer_seg.zero_grad()
-
-            img12 = batch['img12'].to(device)
-
-            displacement_fields = reg_net(img12)
-            seg1_predicted = seg_net(img12[:, [0], :, :, :]).softmax(dim=1)
-            seg2_predicted = seg_net(img12[:, [1], :, :, :]).softmax(dim=1)
-
-            # Below we compute the following:
-            # loss_supervised: supervised segmentation loss; compares ground truth seg with predicted seg
-            # loss_anatomy: anatomy loss; compares warped seg of moving image to seg of target image
-            # loss_metric: a single supervised seg loss, as a metric to track the progress of training
-
-            if 'seg1' in batch.keys() and 'seg2' in batch.keys():
-                seg1 = monai.networks.one_hot(
-                    batch['seg1'].to(device), num_segmentation_classes)
-                seg2 = monai.networks.one_hot(
-                    batch['seg2'].to(device), num_segmentation_classes)
-                loss_metric = dice_loss(seg2_predicted, seg2)
-                loss_supervised = loss_metric + dice_loss(seg1_predicted, seg1)
-                # The above supervised loss looks a bit different from the one in the paper
-                # in that it includes predictions for both images in the current image pair;
-                # we might as well do this, since we have gone to the trouble of loading
-                # both segmentations into memory.
-
-            elif 'seg1' in batch.keys():  # seg1 available, but no seg2
-                seg1 = monai.networks.one_hot(
-                    batch['seg1'].to(device), num_segmentation_classes)
-                loss_metric = dice_loss(seg1_predicted, seg1)
-                loss_supervised = loss_metric
-                seg2 = seg2_predicted  # Use this in anatomy loss
-
-            else:  # seg2 available, but no seg1
-                assert('seg2' in batch.keys())
-                seg2 = monai.networks.one_hot(
-                    batch['seg2'].to(device), num_segmentation_classes)
-                loss_metric = dice_loss(seg2_predicted, seg2)
-                loss_supervised = loss_metric
-                seg1 = seg1_predicted  # Use this in anatomy loss
-
-            # seg1 and seg2 should now be in the form of one-hot class probabilities
-
-            loss_anatomy = dice_loss(warp_nearest(seg2, displacement_fields), seg1)\
-                if 'seg1' in batch.keys() or 'seg2' in batch.keys()\
-                else 0.  # It wouldn't really be 0, but it would not contribute to training seg_net
-
-            # (If you want to refactor this code for *joint* training of reg_net and seg_net,
-            #  then use the definition of anatomy loss given in the function anatomy_loss above,
-            #  where differentiable warping is used and reg net can be trained with it.)
-
-            loss = lambda_a * loss_anatomy + lambda_sp * loss_supervised
-            loss.backward()
-            optimizer_seg.step()
+        for step, batch in enumerate(batch_generator_train_seg(
+                seg_phase_training_batches_per_epoch * accumulation_steps_seg)):
+            if step % accumulation_steps_seg == 0:
+                optimizer_seg.zero_grad()
+
+            with autocast():
+                loss_supervised, loss_anatomy, loss_metric = seg_losses_func(
+                    batch, device, reg_net, seg_net, num_segmentation_classes)
+                loss = lambda_a * loss_anatomy + lambda_sp * loss_supervised
+            scaler_seg.scale(loss / accumulation_steps_seg).backward()
+            if (step + 1) % accumulation_steps_seg == 0:
+                scaler_seg.step(optimizer_seg)
+                scaler_seg.update()
 
             losses.append(loss_metric.item())
             supervised_loss.append(loss_supervised.item())
@@ -348,6 +516,9 @@ def train_network(dataloader_train_reg,
         supervised_loss_seg.append([epoch_number+1, np.mean(supervised_loss)])
         anatomy_loss_seg.append([epoch_number+1, np.mean(anatomy_loss)])
         logger.info(f"\tseg training loss: {training_loss_seg}")
+        logger.info(f"\tseg data loading: {batch_generator_train_seg.wait_summary()}")
+        logger.info(f"\tseg peak memory: {peak_memory_summary(device_type)}")
+        batch_generator_train_seg.reset_wait_stats()
         training_losses_seg.append([epoch_number+1, training_loss_seg])
         logger.info("\tsave latest seg_net checkpoint")
         save_seg_checkpoint(seg_net, optimizer_seg, epoch_number, training_loss_seg, super_loss=supervised_loss_seg,ana_loss=anatomy_loss_seg, total_loss=training_losses_seg, save_dir=os.path.join(result_seg_path, 'checkpoints'), name='latest')
@@ -368,12 +539,20 @@ def train_network(dataloader_train_reg,
                 # because data_seg_available_valid would be empty.
                 seg_net.eval()
                 losses = []
-                with torch.no_grad():
-                    for batch in dataloader_valid_seg:
+                with torch.no_grad(), autocast():
+                    for batch in validation_batches_seg:
                         imgs = batch['img'].to(device)
+                        if channels_last:
+                            imgs = imgs.contiguous(memory_format=torch.channels_last_3d)
                         true_segs = batch['seg'].to(device)
-                        predicted_segs = seg_net(imgs)
-                        loss = dice_loss2(predicted_segs, true_segs)
+                        if patch_size is not None:
+                            # seg_net runs on batch_size_valid_seg patches at a time, the batch size probed
+                            # for its validation steps on patches
+                            predicted_segs = monai.inferers.sliding_window_inference(
+                                imgs, patch_size, batch_size_valid_seg, seg_net)
+                        else:
+                            predicted_segs = seg_net(imgs)
+                        loss = dice_loss2(predicted_segs.float(), true_segs)
                         losses.append(loss.item())
 
                 validation_loss_seg = np.mean(losses)
@@ -396,12 +575,20 @@ def train_network(dataloader_train_reg,
         plot_progress(logger, os.path.join(result_seg_path, 'training_plot'), supervised_loss_seg, [], 'supervised_seg_net_loss')   
         logger.info(f"\tseg lr: {optimizer_seg.param_groups[0]['lr']}")
         logger.info(f"\treg lr: {optimizer_reg.param_groups[0]['lr']}")
+        if volume_cache is not None:
+            logger.info(f"\tvolume cache: {volume_cache.summary()}")
         # scheduler_seg.step()
         # Free up memory
-        del (loss, seg1, seg2, displacement_fields, img12, loss_supervised, loss_anatomy, loss_metric,\
-            seg1_predicted, seg2_predicted)
+        del loss, loss_supervised, loss_anatomy, loss_metric
         torch.cuda.empty_cache()
 
+    batch_generator_train_reg.close()
+    batch_generator_train_seg.close()
+    if num_valid_reg > 0 and fixed_validation_pairs is None:
+        batch_generator_valid_reg.close()
+    if volume_cache is not None:
+        volume_cache.stop_warming()
+
     if len(validation_losses_reg) == 0:
         logger.info('Only small number of pairs are used for training, no need to do validation. Replace best validation loss with training loss !!!')
         logger.info(f'Best reg_net validation loss: {training_loss_reg}')
@@ -176,8 +176,11 @@ def jacobian_determinant(vf):
     This function computes a jacobian determinant by taking discrete differences in each spatial direction.
 
     Returns a numpy array of shape (H-1,W-1,D-1).
+    The determinant is always computed in float32, also for a half precision field.
     """
 
+    if torch.is_tensor(vf):
+        vf = vf.float().numpy()
     _, H, W, D = vf.shape
 
     # Compute discrete spatial derivatives
@@ -292,3 +295,49 @@ def load_best_checkpoint(path, device):
     best_loss = checkpoint['all_loss']['best_loss']
     return best_loss
 
+
+
+def setup_device(backend=None, gpu=None, loader_threads=0):
+    """
+    Select the device to run on and configure the cpu backend, from the backend section of the config.
+
+    backend keys (all optional):
+        device : 'auto' (cuda if available, else cpu), 'cuda' or 'cpu'
+        intra_op_threads : threads of a single op; by default the cores left over by the loader threads
+        inter_op_threads : threads running independent ops concurrently; by default 1
+        onednn : whether to use the oneDNN (mkldnn) kernels and graph fusion on cpu; True by default
+    gpu is the id of the cuda device, the current device if None.
+    loader_threads is the number of threads loading data next to the training loop (prefetch and cache warming),
+    which are subtracted from the cores so that they are not oversubscribed.
+
+    Returns the device and a one line summary of the effective configuration.
+    """
+    backend = backend if backend is not None else {}
+    device_name = backend.get('device', 'auto')
+    if device_name == 'auto':
+        device_name = 'cuda' if torch.cuda.is_available() else 'cpu'
+    if device_name == 'cuda':
+        device = torch.device("cuda:" + str(gpu if gpu is not None else torch.cuda.current_device()))
+        return device, f"device {device} ({torch.cuda.get_device_name(device)})"
+
+    device = torch.device('cpu')
+    num_cores = os.cpu_count() or 1
+    intra_op_threads = backend.get('intra_op_threads', None)
+    if intra_op_threads is None:
+        intra_op_threads = max(1, num_cores - loader_threads)
+    torch.set_num_threads(intra_op_threads)
+    inter_op_threads = backend.get('inter_op_threads', None)
+    try:
+        torch.set_num_interop_threads(inter_op_threads if inter_op_threads is not None else 1)
+    except RuntimeError:
+        # can only be set once, before any inter-op parallel work has started
+        pass
+    onednn = backend.get('onednn', True)
+    torch.backends.mkldnn.enabled = onednn
+    if hasattr(torch.jit, 'enable_onednn_fusion'):
+        torch.jit.enable_onednn_fusion(onednn)
+    summary = (f"device cpu, {num_cores} cores, intra-op threads {torch.get_num_threads()}, "
+               f"inter-op threads {torch.get_num_interop_threads()}, loader threads {loader_threads}, "
+               f"oneDNN {'available' if torch.backends.mkldnn.is_available() else 'unavailable'}, "
+               f"{'enabled' if torch.backends.mkldnn.enabled else 'disabled'}")
+    return device, summary